@@ -4,6 +4,7 @@ import numpy as np
 from simpletransformers.conv_ai import ConvAIModel, ConvAIArgs
 from simpletransformers.config.utils import sweep_config_to_sweep_values
 import torch
+import torch.nn.functional as F
 from transformers import GPT2Config, GPT2DoubleHeadsModel, T5Tokenizer
 
 ATTR_TO_SPECIAL_TOKEN = {
@@ -12,6 +13,7 @@ ATTR_TO_SPECIAL_TOKEN = {
     "pad_token": "<pad>",
     "additional_special_tokens": ["<speaker1>", "<speaker2>"],
 }
+SPECIAL_TOKENS = ["<bos>", "<eos>", "<speaker1>", "<speaker2>", "<pad>"]
 
 
 class ConvAIModelJa(ConvAIModel):
@@ -88,3 +90,121 @@ class ConvAIModelJa(ConvAIModel):
             model.resize_token_embeddings(
                 new_num_tokens=orig_num_tokens + num_added_tokens
             )
+
+    def interact_batch(self, messages, histories, personalities):
+        """Batched version of interact_single() for the replies of many chats.
+
+        Each chat keeps its own persona and history. Returns a list of
+        (reply, history) in the order of messages.
+        """
+        args = self.args
+        tokenizer = self.tokenizer
+        self._move_model_to_device()
+
+        encoded_personalities = [
+            [tokenizer.encode(s.lower()) for s in personality]
+            for personality in personalities
+        ]
+        encoded_histories = [
+            [tokenizer.encode(sentence) for sentence in history + [message]]
+            for message, history in zip(messages, histories)
+        ]
+        with torch.no_grad():
+            out_ids = self.sample_sequences(encoded_personalities, encoded_histories)
+
+        results = []
+        for message, history, ids in zip(messages, histories, out_ids):
+            out_text = tokenizer.decode(ids, skip_special_tokens=True)
+            history = history + [message, out_text]
+            history = history[-(2 * args.max_history + 1) :]
+            results.append((out_text, history))
+        return results
+
+    def sample_sequences(self, personalities, histories):
+        """Batched version of sample_sequence() decoding left-padded inputs."""
+        args = self.args
+        special_tokens_ids = self.tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS)
+        pad_id = self.tokenizer.pad_token_id
+        outputs = [[] for _ in histories]
+        finished = [False] * len(histories)
+
+        for i in range(args.max_length):
+            active = [j for j, done in enumerate(finished) if not done]
+            if not active:
+                break
+            instances = [
+                self.build_input_from_segments(
+                    personalities[j],
+                    histories[j],
+                    outputs[j],
+                    self.tokenizer,
+                    with_eos=False,
+                )
+                for j in active
+            ]
+            # Left padding keeps the next token position at the end of every row.
+            max_len = max(len(instance["input_ids"]) for instance in instances)
+            input_ids = torch.full((len(active), max_len), pad_id, dtype=torch.long)
+            token_type_ids = torch.full_like(input_ids, pad_id)
+            attention_mask = torch.zeros_like(input_ids)
+            for row, instance in enumerate(instances):
+                length = len(instance["input_ids"])
+                input_ids[row, max_len - length :] = torch.tensor(instance["input_ids"])
+                token_type_ids[row, max_len - length :] = torch.tensor(
+                    instance["token_type_ids"]
+                )
+                attention_mask[row, max_len - length :] = 1
+            position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+            logits = self.model(
+                input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                token_type_ids=token_type_ids.to(self.device),
+                position_ids=position_ids.to(self.device),
+            )[0]
+            logits = logits[:, -1, :] / args.temperature
+            logits = self._top_filtering_batch(
+                logits, top_k=args.top_k, top_p=args.top_p
+            )
+            if i < args.min_length:
+                # Same as re-sampling until a non special token comes out,
+                # unless only special tokens are left.
+                masked = logits.clone()
+                masked[:, special_tokens_ids] = -float("Inf")
+                only_special = torch.isinf(masked).all(dim=-1, keepdim=True)
+                logits = torch.where(only_special, logits, masked)
+            probs = F.softmax(logits, dim=-1)
+            if args.do_sample:
+                prev = torch.multinomial(probs, 1)
+            else:
+                prev = torch.topk(probs, 1)[1]
+
+            for row, j in enumerate(active):
+                token = prev[row].item()
+                if token in special_tokens_ids:
+                    finished[j] = True
+                else:
+                    outputs[j].append(token)
+        return outputs
+
+    def _top_filtering_batch(
+        self, logits, top_k=0, top_p=0.0, filter_value=-float("Inf")
+    ):
+        """Row-wise top-k and nucleus filtering of (batch_size, vocab_size) logits."""
+        top_k = min(top_k, logits.size(-1))
+        if top_k > 0:
+            kth_logits = torch.topk(logits, top_k)[0][:, -1, None]
+            logits = logits.masked_fill(logits < kth_logits, filter_value)
+
+        if top_p > 0.0:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+            sorted_indices_to_remove = cumulative_probs > top_p
+            # Keep the first token above the threshold.
+            sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
+            sorted_indices_to_remove[:, 0] = False
+            indices_to_remove = sorted_indices_to_remove.scatter(
+                1, sorted_indices, sorted_indices_to_remove
+            )
+            logits = logits.masked_fill(indices_to_remove, filter_value)
+        return logits
@@ -45,8 +45,9 @@ def norm_box(boxes, raw_sizes):
         normalized_boxes = boxes.copy()
     else:
         normalized_boxes = boxes.clone()
-    normalized_boxes[:, :, (0, 2)] /= raw_sizes[:, 1]
-    normalized_boxes[:, :, (1, 3)] /= raw_sizes[:, 0]
+    # Each image's boxes are divided by its own (height, width).
+    normalized_boxes[:, :, (0, 2)] /= raw_sizes[:, None, 1:2]
+    normalized_boxes[:, :, (1, 3)] /= raw_sizes[:, None, 0:1]
     return normalized_boxes
 
 
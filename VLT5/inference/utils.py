@@ -567,12 +567,33 @@ def get_demo_path():
 
 
 def img_tensorize(im, input_format="RGB"):
-    assert isinstance(im, str)
-    if os.path.isfile(im):
-        img = cv2.imread(im)
+    """
+    Args:
+        im: file path, url, encoded image bytes, PIL image or numpy array.
+            numpy arrays are expected in the BGR channel order of cv2.imread.
+    """
+    # Raised rather than asserted, since the image may be an untrusted request body.
+    if isinstance(im, (bytes, bytearray, memoryview)):
+        img = cv2.imdecode(np.frombuffer(im, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("could not decode image bytes")
+    elif isinstance(im, Image.Image):
+        img = cv2.cvtColor(np.asarray(im.convert("RGB")), cv2.COLOR_RGB2BGR)
+    elif isinstance(im, np.ndarray):
+        img = im
+    elif isinstance(im, str):
+        if os.path.isfile(im):
+            img = cv2.imread(im)
+            if img is None:
+                raise ValueError(f"could not decode image file: {im}")
+        elif im.startswith(("http://", "https://")):
+            img = get_image_from_url(im)
+            if img is None:
+                raise ValueError(f"could not connect to: {im}")
+        else:
+            raise ValueError(f"no such image file: {im}")
     else:
-        img = get_image_from_url(im)
-        assert img is not None, f"could not connect to: {im}"
+        raise TypeError(f"unsupported image type: {type(im).__name__}")
 
     if input_format == "RGB":
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SECONDS = metrics.Histogram(
+    "admission_queue_seconds", "Time an admitted job waited for a slot."
+)
+WAITING = metrics.Gauge("admission_waiting_jobs", "Jobs waiting for a slot.")
+RUNNING = metrics.Gauge("admission_running_jobs", "Jobs holding a slot.")
+REJECTED = metrics.Counter(
+    "admission_rejected_total", "Jobs rejected because the queue was full."
+)
+
+
+class AdmissionRejectedError(Exception):
+    pass
+
+
+class AdmissionController:
+    """Bounds the number of expensive jobs running and waiting to run.
+
+    At most max_concurrency jobs run at the same time and at most max_depth
+    jobs wait for a slot. A job arriving when the queue is full is rejected
+    immediately with AdmissionRejectedError instead of waiting without bound.
+    """
+
+    def __init__(self, name, max_depth=8, max_concurrency=1):
+        self.name = name
+        self.max_depth = max_depth
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.running = 0
+
+    @asynccontextmanager
+    async def admit(self):
+        if self._semaphore.locked() and self.waiting >= self.max_depth:
+            REJECTED.inc(name=self.name)
+            raise AdmissionRejectedError(
+                f"{self.waiting} {self.name} jobs are already waiting."
+            )
+
+        self.waiting += 1
+        WAITING.set(self.waiting, name=self.name)
+        enqueued = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            WAITING.set(self.waiting, name=self.name)
+        queue_time = time.perf_counter() - enqueued
+        QUEUE_SECONDS.observe(queue_time, name=self.name)
+        logger.info(
+            "%s job waited %.3fs for admission. (waiting = %d, running = %d)",
+            self.name,
+            queue_time,
+            self.waiting,
+            self.running,
+        )
+
+        self.running += 1
+        RUNNING.set(self.running, name=self.name)
+        try:
+            yield queue_time
+        finally:
+            self.running -= 1
+            RUNNING.set(self.running, name=self.name)
+            self._semaphore.release()
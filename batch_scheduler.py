@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+from inference_executor import InferenceQueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """Collects concurrent requests and runs them through the executor as one batch.
+
+    A batch is sent to the executor when batch_window seconds have passed
+    since its first request, when max_batch_size requests are waiting, or when
+    a running batch finishes while max_inflight batches were already running.
+
+    method is called with one list per argument of submit, and returns one
+    result per request. A result that is an exception is raised only to its
+    own request.
+    """
+
+    def __init__(
+        self,
+        executor,
+        method,
+        batch_window=0.02,
+        max_batch_size=8,
+        max_inflight=1,
+        max_pending=256,
+        pending_gauge=None,
+    ):
+        self.executor = executor
+        self.method = method
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_inflight = max_inflight
+        self.max_pending = max_pending
+        self.pending_gauge = pending_gauge
+        self._pending = []
+        self._inflight = 0
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, *args):
+        if len(self._pending) >= self.max_pending:
+            raise InferenceQueueFullError(
+                f"{len(self._pending)} {self.method} requests are already pending."
+            )
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((args, future))
+        self._set_pending()
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    def _set_pending(self):
+        if self.pending_gauge is not None:
+            self.pending_gauge.set(len(self._pending))
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending or self._inflight >= self.max_inflight:
+            # The pending requests are flushed when a running batch finishes.
+            return
+        batch = self._pending[: self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size :]
+        self._set_pending()
+        self._inflight += 1
+        task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch):
+        args, futures = zip(*batch)
+        logger.info("Running %d %s requests in one batch.", len(batch), self.method)
+        try:
+            results = await self.executor.run(
+                self.method, *(list(arg) for arg in zip(*args))
+            )
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future, result in zip(futures, results):
+                # The awaiting handler may have been cancelled.
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self._inflight -= 1
+            if self._pending:
+                self._flush()
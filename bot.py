@@ -2,9 +2,13 @@ import logging
 import os
 
 from telegram import __version__ as TG_VER
-from GPT2.conv_ai_model_ja import ConvAIModelJa
 
-from persona_captiopn import PersonaCaption
+import metrics
+from admission import AdmissionRejectedError
+from inference_executor import InferenceQueueFullError
+from model_context import ModelNotLoadedError
+from serving import PERSONA_OUTPUT_NUM, InferenceServices
+from session_store import SessionStore
 
 try:
     from telegram import __version_info__
@@ -35,21 +39,26 @@ logger = logging.getLogger(__name__)
 
 PHOTO, CHAT = range(2)
 TOKEN = os.environ.get("TOKEN")
-PERSONA_LIST = []
-DIALOG_HISTORY = []
-
-# Dialogue model training was used JPersonaChat(5 pairs of personas), so output num is 5.
-PERSONA_OUTPUT_NUM = 5
-
-CONV_AI_PARAMS = {
-    "do_sample": True,
-    "temperature": 1.0,
-    "top_k": 50,
-    "top_p": 0.9,
-    "max_history": 3,
-    "max_length": 50,
-    "min_length": 10,
-}
+# "polling" or "webhook".
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+# Public URL registered to Telegram. Derived from listen, port and path if empty.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Bot API server, e.g. the fake server of fake_telegram.py for local testing.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+# GET /metrics is served in the Prometheus format if the port is set.
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# Keys of the objects stored in Application.bot_data.
+SERVICES_KEY = "services"
+SESSIONS_KEY = "sessions"
+SESSION_MAX = int(os.environ.get("SESSION_MAX", 10000))
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 3600))
+
+BUSY_MESSAGE = "現在混み合っています。\nしばらくしてからもう一度お試しください。"
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -57,9 +66,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
     logger.info("User %s activated this bot", user.first_name)
 
-    global PERSONA_LIST, DIALOG_HISTORY
-    PERSONA_LIST = []
-    DIALOG_HISTORY = []
+    session = context.bot_data[SESSIONS_KEY].get(update.effective_chat.id)
+    async with session.lock:
+        session.reset()
 
     await update.message.reply_text(
         "こんにちは、ペルソナ対話ボットです。\n私は送信された人物のペルソナに沿ってチャットを行います。\n\n"
@@ -73,24 +82,35 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the photo."""
     user = update.message.from_user
-    photo_file = await update.message.photo[-1].get_file()
-
-    if not os.path.exists("./photo"):
-        os.mkdir("./photo")
-
-    image_path = "./photo/portrait.jpg"
-    await photo_file.download_to_drive(image_path)
-    logger.info("Photo of User %s: %s", user.first_name, image_path)
-
-    persona_caption = PersonaCaption()
-    global PERSONA_LIST
-    PERSONA_LIST = persona_caption.get_persona_list(image_path, PERSONA_OUTPUT_NUM)
-    assert PERSONA_OUTPUT_NUM == len(PERSONA_LIST)
+    services = context.bot_data[SERVICES_KEY]
+
+    try:
+        # The photo is downloaded only after admission,
+        # so waiting jobs do not hold image buffers.
+        async with services.photo_admission.admit():
+            photo_file = await update.message.photo[-1].get_file()
+            # The photo is decoded in memory without being written to disk.
+            image = bytes(await photo_file.download_as_bytearray())
+            logger.info("Photo of User %s: %d bytes", user.first_name, len(image))
+
+            persona_list = await services.executor.run(
+                "get_persona_list", image, PERSONA_OUTPUT_NUM
+            )
+    except (AdmissionRejectedError, InferenceQueueFullError) as e:
+        logger.warning("Photo of User %s was rejected: %s", user.first_name, e)
+        await update.message.reply_text(BUSY_MESSAGE)
+        return PHOTO
+    assert PERSONA_OUTPUT_NUM == len(persona_list)
+
+    session = context.bot_data[SESSIONS_KEY].get(update.effective_chat.id)
+    async with session.lock:
+        session.persona_list = persona_list
+        session.dialog_history = []
 
     await update.message.reply_text(
         "ありがとうございます。この人物のペルソナは以下になります。\n\n"
         + "----------\n"
-        + "\n".join(PERSONA_LIST)
+        + "\n".join(persona_list)
         + "\n----------\n\n"
         "以上をボットのペルソナとして設定します。\n\n"
         "チャットを始めましょう!"
@@ -104,16 +124,25 @@ async def skip_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
     logger.info("User %s did not send a photo.", user.first_name)
 
-    persona_caption = PersonaCaption()
-    global PERSONA_LIST
-    PERSONA_LIST = persona_caption.get_random_persona_list(PERSONA_OUTPUT_NUM)
-    assert PERSONA_OUTPUT_NUM == len(PERSONA_LIST)
+    try:
+        persona_list = await context.bot_data[SERVICES_KEY].executor.run(
+            "get_random_persona_list", PERSONA_OUTPUT_NUM
+        )
+    except InferenceQueueFullError:
+        await update.message.reply_text(BUSY_MESSAGE)
+        return PHOTO
+    assert PERSONA_OUTPUT_NUM == len(persona_list)
+
+    session = context.bot_data[SESSIONS_KEY].get(update.effective_chat.id)
+    async with session.lock:
+        session.persona_list = persona_list
+        session.dialog_history = []
 
     await update.message.reply_text(
         "画像の送信をスキップしました。\n"
         "ランダムに選択されたペルソナは以下になります。\n\n"
         + "----------\n"
-        + "\n".join(PERSONA_LIST)
+        + "\n".join(persona_list)
         + "\n----------\n\n"
         "以上をボットのペルソナとして設定します。\n\n"
         "チャットを始めましょう!"
@@ -128,20 +157,27 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     user_message = update.message.text
 
-    if not os.path.exists("./GPT2/model") or not os.path.isfile(
-        "./GPT2/model/pytorch_model.bin"
-    ):
-        logger.error(
-            "GPT2 model file pytorch_model.bin is not placed under ./GPT2/model"
-        )
-        await update.message.reply_text("内部エラーが発生しました。\n現在チャットを行うことができません。")
-        return ConversationHandler.END
-
-    model = ConvAIModelJa("./GPT2/model/", args=CONV_AI_PARAMS)
-    global DIALOG_HISTORY, PERSONA_LIST
-    reply, DIALOG_HISTORY = model.interact_single(
-        user_message, history=DIALOG_HISTORY, personality=PERSONA_LIST
-    )
+    scheduler = context.bot_data[SERVICES_KEY].reply_scheduler
+    session = context.bot_data[SESSIONS_KEY].get(update.effective_chat.id)
+    async with session.lock:
+        if not session.persona_list:
+            # The session was evicted or expired while the conversation was idle.
+            logger.info("Session of User %s has expired.", user.first_name)
+            await update.message.reply_text(
+                "セッションの有効期限が切れました。\n/startコマンドでもう一度チャットを始めてください。"
+            )
+            return ConversationHandler.END
+        try:
+            reply, session.dialog_history = await scheduler.reply(
+                user_message, session.dialog_history, session.persona_list
+            )
+        except ModelNotLoadedError:
+            logger.error("GPT2 model is not loaded.")
+            await update.message.reply_text("内部エラーが発生しました。\n現在チャットを行うことができません。")
+            return ConversationHandler.END
+        except InferenceQueueFullError:
+            await update.message.reply_text(BUSY_MESSAGE)
+            return
 
     logger.info("User %s send 「%s」 to bot", user.first_name, user_message)
     await update.message.reply_text(reply)
@@ -155,16 +191,44 @@ async def goodbye(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         reply_markup=ReplyKeyboardRemove(),
     )
     # re-initialize
-    global PERSONA_LIST, DIALOG_HISTORY
-    PERSONA_LIST = []
-    DIALOG_HISTORY = []
+    context.bot_data[SESSIONS_KEY].pop(update.effective_chat.id)
     return ConversationHandler.END
 
 
+async def post_init(application: Application) -> None:
+    # Updates are fetched only after post_init returns,
+    # so the bot becomes ready after the warm-up.
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT, METRICS_LISTEN)
+    await application.bot_data[SERVICES_KEY].start()
+    logger.info("Bot is ready.")
+
+
+async def shutdown(application: Application) -> None:
+    application.bot_data[SERVICES_KEY].shutdown()
+
+
 def main() -> None:
     """Run the bot."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    # Updates of different chats are handled concurrently,
+    # while inference runs in the executor.
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(
+            f"{TELEGRAM_API_URL}/file/bot"
+        )
+    application = builder.build()
+    application.bot_data[SERVICES_KEY] = InferenceServices()
+    application.bot_data[SESSIONS_KEY] = SessionStore(
+        max_sessions=SESSION_MAX, ttl=SESSION_TTL
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -181,7 +245,18 @@ def main() -> None:
     application.add_handler(conv_handler)
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        # Updates are received by the embedded HTTP server and
+        # fed into the same ConversationHandler.
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
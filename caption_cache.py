@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+from VLT5.inference.utils import img_tensorize
+
+logger = logging.getLogger(__name__)
+
+CAPTION_CACHE_SIZE = int(os.environ.get("CAPTION_CACHE_SIZE", 256))
+CAPTION_CACHE_DIR = os.environ.get("CAPTION_CACHE_DIR")
+
+LOOKUPS = metrics.Counter(
+    "caption_cache_lookups_total",
+    "Caption cache lookups by stage and result (memory, disk or miss).",
+)
+
+
+def config_fingerprint(*parts):
+    """Returns a short hash of the given strings."""
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode() + b"\0")
+    return sha.hexdigest()[:16]
+
+
+class ImageDecodeError(ValueError):
+    pass
+
+
+def decode_image(image):
+    """Returns the image as a BGR numpy array and the hash of its pixels.
+
+    The same photo re-encoded or sent as a path, bytes or PIL image gets the
+    same hash as long as it decodes to the same pixels.
+    """
+    try:
+        image = img_tensorize(image, input_format="BGR")
+    except (ValueError, TypeError) as e:
+        raise ImageDecodeError(f"Could not decode the image: {e}") from e
+    sha = hashlib.sha256(f"{image.shape}{image.dtype}".encode())
+    sha.update(np.ascontiguousarray(image).data)
+    return image, sha.hexdigest()
+
+
+class CaptionCache:
+    """Results of each stage of PersonaCaption keyed by image content and config.
+
+    Up to max_entries results are kept in memory with LRU eviction. If
+    cache_dir is set, every result is also written under it, so the results
+    outlive the process and are shared by the worker processes. With neither,
+    the cache is disabled.
+    """
+
+    def __init__(self, max_entries=CAPTION_CACHE_SIZE, cache_dir=CAPTION_CACHE_DIR):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 or bool(self.cache_dir)
+
+    def get(self, stage, key):
+        """Returns the cached result of the stage, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            value = self._entries.get((stage, key))
+            if value is not None:
+                self._entries.move_to_end((stage, key))
+        if value is not None:
+            LOOKUPS.inc(stage=stage, result="memory")
+            return value
+
+        path = self._path(stage, key)
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    value = pickle.load(f)
+            except Exception:
+                logger.warning("Could not read the cached %s result %s", stage, path)
+            else:
+                LOOKUPS.inc(stage=stage, result="disk")
+                self._remember(stage, key, value)
+                return value
+        LOOKUPS.inc(stage=stage, result="miss")
+        return None
+
+    def put(self, stage, key, value):
+        if not self.enabled:
+            return
+        self._remember(stage, key, value)
+        path = self._path(stage, key)
+        if path is not None:
+            # Written to a temporary file first so that readers never see a partial file.
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    def _remember(self, stage, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[(stage, key)] = value
+            self._entries.move_to_end((stage, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, stage, key):
+        if not self.cache_dir:
+            return None
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{stage}.{name}.pkl")
@@ -0,0 +1,229 @@
+"""Pipelined persona captioning of many images.
+
+python caption_pipeline.py --n 5 --batch-size 4 --output personas.jsonl photos/*.jpg
+"""
+
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+
+from persona_captiopn import BATCH_IMAGES, BATCH_STAGE_SECONDS, PersonaCaption
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class _Stage:
+    def __init__(self, name, func, input_queue, output_queue, stopped):
+        self.name = name
+        self.func = func
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.stopped = stopped
+        self.batches = 0
+        self.images = 0
+        self.busy_seconds = 0.0
+        self.thread = threading.Thread(
+            target=self._run, name=f"caption-{name}", daemon=True
+        )
+
+    def _run(self):
+        while True:
+            batch = _get(self.input_queue, self.stopped)
+            if batch is None:
+                return
+            if batch is _DONE:
+                _put(self.output_queue, _DONE, self.stopped)
+                return
+            if batch["error"] is None:
+                started = time.perf_counter()
+                try:
+                    self.func(batch)
+                except Exception as e:
+                    logger.exception("Stage %s failed.", self.name)
+                    batch["error"] = e
+                seconds = time.perf_counter() - started
+                BATCH_STAGE_SECONDS.observe(seconds, stage=self.name)
+                self.busy_seconds += seconds
+                self.batches += 1
+                self.images += len(batch["indices"])
+            if not _put(self.output_queue, batch, self.stopped):
+                return
+
+
+def _get(q, stopped):
+    # Times out regularly so that the threads end when the pipeline is closed.
+    while not stopped.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def _put(q, item, stopped):
+    while not stopped.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class CaptionPipeline:
+    """Runs each stage of PersonaCaption in its own thread over a stream of images.
+
+    The images are grouped into batches of batch_size, and each stage works on
+    one batch while the previous stage works on the next one. The queues
+    between the stages hold at most queue_size batches, so a slow stage holds
+    back the reading of images instead of buffering the whole archive.
+    """
+
+    def __init__(
+        self, persona_caption, persona_output_num=5, batch_size=4, queue_size=2
+    ):
+        self.persona_caption = persona_caption
+        self.persona_output_num = persona_output_num
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.stages = []
+        self.images = 0
+        self.failed = 0
+        self.wall_seconds = 0.0
+
+    def run(self, images):
+        """Yields (index, persona list) in input order for an iterable of images.
+
+        If a stage fails on a batch, the exception is yielded in place of the
+        persona list of each of its images. An image that cannot be decoded
+        gets its own exception without failing the rest of its batch. If the
+        iterable of images raises, the exception is raised here after the
+        results of the images read before it.
+        """
+        stage_funcs = self.persona_caption.pipeline_stages(self.persona_output_num)
+        queues = [
+            queue.Queue(maxsize=self.queue_size) for _ in range(len(stage_funcs) + 1)
+        ]
+        stopped = threading.Event()
+        self.stages = [
+            _Stage(name, func, queues[i], queues[i + 1], stopped)
+            for i, (name, func) in enumerate(stage_funcs)
+        ]
+        self.images = 0
+        self.failed = 0
+        self._feed_error = None
+        feeder = threading.Thread(
+            target=self._feed, args=(images, queues[0], stopped), daemon=True
+        )
+
+        started = time.perf_counter()
+        for stage in self.stages:
+            stage.thread.start()
+        feeder.start()
+        try:
+            while True:
+                batch = queues[-1].get()
+                if batch is _DONE:
+                    break
+                failed = batch.get("failed", {})
+                persona_lists = iter(batch.get("persona_lists", []))
+                for i, index in enumerate(batch["indices"]):
+                    if batch["error"] is not None:
+                        self.failed += 1
+                        yield index, batch["error"]
+                    elif i in failed:
+                        self.failed += 1
+                        yield index, failed[i]
+                    else:
+                        yield index, next(persona_lists)
+                self.images += len(batch["indices"])
+                BATCH_IMAGES.inc(len(batch["indices"]))
+            if self._feed_error is not None:
+                raise self._feed_error
+        finally:
+            # Also ends the threads when the caller stops iterating early.
+            stopped.set()
+            self.wall_seconds = time.perf_counter() - started
+
+    def _feed(self, images, input_queue, stopped):
+        batch = {"indices": [], "images": [], "error": None}
+        try:
+            for index, image in enumerate(images):
+                batch["indices"].append(index)
+                batch["images"].append(image)
+                if len(batch["indices"]) >= self.batch_size:
+                    if not _put(input_queue, batch, stopped):
+                        return
+                    batch = {"indices": [], "images": [], "error": None}
+        except Exception as e:
+            # run() raises it once the images read before it are done.
+            logger.exception("Reading the images failed.")
+            self._feed_error = e
+        if batch["indices"] and not _put(input_queue, batch, stopped):
+            return
+        _put(input_queue, _DONE, stopped)
+
+    def report(self):
+        """Returns the throughput of the whole pipeline and of each stage."""
+        lines = [
+            f"{self.images} images ({self.failed} failed) in {self.wall_seconds:.2f}s "
+            f"({self.images / max(self.wall_seconds, 1e-9):.2f} images/s)"
+        ]
+        for stage in self.stages:
+            # The rate of a stage running alone, and the share of the wall time
+            # it was busy. The busiest stage bounds the pipeline throughput.
+            rate = stage.images / max(stage.busy_seconds, 1e-9)
+            utilization = stage.busy_seconds / max(self.wall_seconds, 1e-9)
+            lines.append(
+                f"  {stage.name:<10} {stage.images:>6} images "
+                f"{stage.busy_seconds:>8.2f}s busy {rate:>8.2f} images/s "
+                f"{utilization:>6.1%} utilization"
+            )
+        return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="+", help="image files")
+    parser.add_argument("--n", type=int, default=5, help="personas per image")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=2)
+    parser.add_argument("--output", help="JSON lines file of the persona lists")
+    args = parser.parse_args()
+
+    pipeline = CaptionPipeline(
+        PersonaCaption(), args.n, batch_size=args.batch_size, queue_size=args.queue_size
+    )
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    try:
+        for index, persona_list in pipeline.run(args.images):
+            result = {"image": args.images[index]}
+            if isinstance(persona_list, Exception):
+                result["error"] = str(persona_list)
+            else:
+                result["persona_list"] = persona_list
+            if output is not None:
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+    finally:
+        if output is not None:
+            output.close()
+    logger.info("Throughput:\n%s", pipeline.report())
+    if pipeline.failed:
+        logger.warning(
+            "%d of %d images failed. See the errors above.",
+            pipeline.failed,
+            pipeline.images,
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()
@@ -0,0 +1,38 @@
+import metrics
+from batch_scheduler import BatchScheduler
+
+CAPTION_SECONDS = metrics.Histogram(
+    "caption_seconds", "Latency of a caption from its request to its result."
+)
+PENDING = metrics.Gauge(
+    "caption_pending_requests", "Caption requests waiting to be batched."
+)
+
+
+class CaptionScheduler(BatchScheduler):
+    """Collects the caption requests of many clients and captions them as one batch.
+
+    Detection and VQA of the images of a batch run in one forward pass each.
+    """
+
+    def __init__(
+        self,
+        executor,
+        batch_window=0.02,
+        max_batch_size=8,
+        max_inflight=1,
+        max_pending=8,
+    ):
+        super().__init__(
+            executor,
+            "caption_batch",
+            batch_window=batch_window,
+            max_batch_size=max_batch_size,
+            max_inflight=max_inflight,
+            max_pending=max_pending,
+            pending_gauge=PENDING,
+        )
+
+    async def caption(self, image, persona_output_num):
+        with CAPTION_SECONDS.time():
+            return await self.submit(image, persona_output_num)
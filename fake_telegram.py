@@ -0,0 +1,167 @@
+"""Local fake of Telegram for testing the bot in webhook mode.
+
+# Terminal 1: fake Bot API answering the requests of the bot.
+python fake_telegram.py serve --port 8081 --photo ./images/persona_caption.png
+# Terminal 2: the bot pointed at the fake Bot API.
+TOKEN=dummy BOT_MODE=webhook TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+# Terminal 3: send updates to the webhook of the bot.
+python fake_telegram.py send --text /start
+python fake_telegram.py send --photo
+python fake_telegram.py send --text こんにちは
+"""
+
+import argparse
+import json
+import logging
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+FAKE_BOT = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "FakeBot",
+    "username": "fake_bot",
+}
+FAKE_PHOTO_ID = "fake-photo"
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """Answers Bot API methods with minimal successful results."""
+
+    photo = b""
+
+    def do_GET(self):
+        if self.path.startswith("/file/"):
+            self._send(200, self.photo, "application/octet-stream")
+        else:
+            self._answer()
+
+    def do_POST(self):
+        self._answer()
+
+    def _answer(self):
+        method = self.path.rstrip("/").split("/")[-1]
+        params = self._read_params()
+        if method == "getMe":
+            result = FAKE_BOT
+        elif method == "sendMessage":
+            logger.info(
+                "Bot replied to chat %s: %s", params.get("chat_id"), params.get("text")
+            )
+            result = {
+                "message_id": int(time.time() * 1000) % 2**31,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "from": FAKE_BOT,
+                "text": params.get("text", ""),
+            }
+        elif method == "getFile":
+            result = {
+                "file_id": params.get("file_id", FAKE_PHOTO_ID),
+                "file_unique_id": FAKE_PHOTO_ID,
+                "file_size": len(self.photo),
+                "file_path": f"photos/{FAKE_PHOTO_ID}.jpg",
+            }
+        else:
+            logger.info("Bot called %s %s", method, params)
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self._send(200, body, "application/json")
+
+    def _read_params(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode(errors="ignore")
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or "{}")
+        # Only the url-encoded parameters are parsed. Multipart uploads are ignored.
+        return {k: v[0] for k, v in parse_qs(body).items()}
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(args):
+    if args.photo:
+        with open(args.photo, "rb") as f:
+            FakeBotApiHandler.photo = f.read()
+    server = ThreadingHTTPServer((args.host, args.port), FakeBotApiHandler)
+    logger.info("Fake Bot API is listening on http://%s:%d", args.host, args.port)
+    server.serve_forever()
+
+
+def build_update(args):
+    now = int(time.time())
+    message = {
+        "message_id": now % 2**31,
+        "date": now,
+        "chat": {"id": args.chat_id, "type": "private"},
+        "from": {"id": args.chat_id, "is_bot": False, "first_name": args.first_name},
+    }
+    if args.photo:
+        message["photo"] = [
+            {
+                "file_id": FAKE_PHOTO_ID,
+                "file_unique_id": FAKE_PHOTO_ID,
+                "width": 640,
+                "height": 480,
+            }
+        ]
+    else:
+        message["text"] = args.text
+        if args.text.startswith("/"):
+            command_length = len(args.text.split()[0])
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": command_length}
+            ]
+    return {"update_id": now % 2**31, "message": message}
+
+
+def send(args):
+    update = build_update(args)
+    request = urllib.request.Request(
+        args.webhook,
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    if args.secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", args.secret)
+    with urllib.request.urlopen(request) as response:
+        logger.info("Webhook answered %d to %s", response.status, update["message"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the fake Bot API")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8081)
+    serve_parser.add_argument("--photo", help="image returned for every file download")
+    serve_parser.set_defaults(func=serve)
+
+    send_parser = subparsers.add_parser("send", help="send an update to the webhook")
+    send_parser.add_argument("--webhook", default="http://127.0.0.1:8443/telegram")
+    send_parser.add_argument("--secret", default="")
+    send_parser.add_argument("--chat-id", type=int, default=1000)
+    send_parser.add_argument("--first-name", default="tester")
+    send_parser.add_argument("--text", default="/start")
+    send_parser.add_argument("--photo", action="store_true", help="send a photo")
+    send_parser.set_defaults(func=send)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
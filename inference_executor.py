@@ -0,0 +1,159 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+from model_context import ModelContext
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SECONDS = metrics.Histogram(
+    "inference_queue_seconds", "Time an inference job waited for a worker."
+)
+RUN_SECONDS = metrics.Histogram(
+    "inference_run_seconds", "Time an inference job ran on a worker."
+)
+PENDING = metrics.Gauge(
+    "inference_pending_jobs", "Inference jobs queued or running in the executor."
+)
+REJECTED = metrics.Counter(
+    "inference_rejected_total", "Inference jobs rejected because the queue was full."
+)
+
+# ModelContext owned by a worker of the process executor.
+_worker_models = None
+
+
+def _init_worker(model_kwargs, warm_up):
+    global _worker_models
+    _worker_models = ModelContext(**model_kwargs)
+    if warm_up:
+        _worker_models.warm_up()
+
+
+def _call_worker(method, *args):
+    # Metrics observed in the worker are replayed in the serving process.
+    with metrics.capture() as observations:
+        result = getattr(_worker_models, method)(*args)
+    return result, observations
+
+
+def _timed_call(func, *args):
+    # time.time() is used because the job may start in another process.
+    started = time.time()
+    result = func(*args)
+    return result, started, time.time()
+
+
+class InferenceQueueFullError(Exception):
+    pass
+
+
+class InferenceExecutor:
+    """Runs blocking ModelContext methods outside the asyncio event loop.
+
+    With kind="thread" the jobs share the given ModelContext. With
+    kind="process" every worker process loads its own ModelContext from
+    model_kwargs and warms it up if warm_up is set. At most max_pending jobs
+    may be queued or running; further jobs are rejected with
+    InferenceQueueFullError.
+    """
+
+    def __init__(
+        self,
+        models=None,
+        kind="thread",
+        max_workers=1,
+        max_pending=32,
+        model_kwargs=None,
+        warm_up=True,
+    ):
+        if kind == "thread":
+            if models is None:
+                raise ValueError("Thread executor requires a loaded ModelContext.")
+            self._pool = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="inference"
+            )
+        elif kind == "process":
+            # CUDA can not be re-initialized in a forked process.
+            self._pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model_kwargs or {}, warm_up),
+            )
+        else:
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.models = models
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.warm_up = warm_up
+        self.pending = 0
+        self.ready = False
+
+    async def start(self, poll_interval=1.0):
+        """Returns after the models of every worker are loaded and warmed up."""
+        if self.kind == "thread":
+            if self.warm_up:
+                await self.run("warm_up")
+        else:
+            # A worker runs its initializer before any job,
+            # so a worker is ready once it returned its pid.
+            loop = asyncio.get_running_loop()
+            ready_pids = set()
+            while True:
+                pids = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(self._pool, os.getpid)
+                        for _ in range(self.max_workers)
+                    )
+                )
+                ready_pids.update(pids)
+                if len(ready_pids) >= self.max_workers:
+                    break
+                await asyncio.sleep(poll_interval)
+        self.ready = True
+        logger.info("%d inference workers are ready.", self.max_workers)
+
+    async def run(self, method, *args):
+        if self.pending >= self.max_pending:
+            REJECTED.inc(method=method)
+            raise InferenceQueueFullError(
+                f"{self.pending} inference jobs are already pending."
+            )
+
+        if self.kind == "thread":
+            job = functools.partial(_timed_call, getattr(self.models, method), *args)
+        else:
+            job = functools.partial(_timed_call, _call_worker, method, *args)
+
+        self.pending += 1
+        PENDING.set(self.pending)
+        submitted = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+            result, started, finished = await loop.run_in_executor(self._pool, job)
+        finally:
+            self.pending -= 1
+            PENDING.set(self.pending)
+        if self.kind == "process":
+            result, observations = result
+            metrics.replay(observations)
+        QUEUE_SECONDS.observe(started - submitted, method=method)
+        RUN_SECONDS.observe(finished - started, method=method)
+        logger.info(
+            "Inference job %s waited %.3fs and ran %.3fs. (pending = %d)",
+            method,
+            started - submitted,
+            finished - started,
+            self.pending,
+        )
+        return result
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,174 @@
+"""HTTP API serving persona captions and dialogue replies without Telegram.
+
+GET  /healthz                  200 once the models are warmed up, else 503
+GET  /metrics                  latency histograms, counters and gauges
+                               in the Prometheus text format
+POST /caption?n=5              body: encoded image -> {"persona_list": [...]}
+GET  /persona/random?n=5       -> {"persona_list": [...]}
+POST /reply                    body: {"message": str, "history": [str],
+                                      "persona": [str]}
+                               -> {"reply": str, "history": [str]}
+
+The inference routes answer 503 until the models are warmed up.
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+import tornado.web
+
+import metrics
+from inference_executor import InferenceQueueFullError
+from model_context import InvalidRequestError, ModelNotLoadedError
+from serving import PERSONA_OUTPUT_NUM, InferenceServices
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+HTTP_API_LISTEN = os.environ.get("HTTP_API_LISTEN", "127.0.0.1")
+HTTP_API_PORT = int(os.environ.get("HTTP_API_PORT", 8000))
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self, services):
+        self.services = services
+
+    def write_json(self, data, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.finish(json.dumps(data, ensure_ascii=False))
+
+    def write_busy(self, error):
+        self.set_header("Retry-After", "1")
+        self.write_json({"error": str(error)}, status=503)
+
+    def get_output_num(self):
+        try:
+            return int(self.get_query_argument("n", PERSONA_OUTPUT_NUM))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "n must be an integer.")
+
+
+class InferenceHandler(BaseHandler):
+    def prepare(self):
+        # The server listens during the warm-up only to answer /healthz.
+        if not self.services.ready:
+            self.write_busy("Models are warming up.")
+
+
+class HealthHandler(BaseHandler):
+    def get(self):
+        self.write_json(
+            {"ready": self.services.ready}, status=200 if self.services.ready else 503
+        )
+
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(metrics.REGISTRY.render())
+
+
+class CaptionHandler(InferenceHandler):
+    async def post(self):
+        persona_output_num = self.get_output_num()
+        if not self.request.body:
+            raise tornado.web.HTTPError(400, "Request body must be an image.")
+        try:
+            # Photos of concurrent requests are captioned together in one batch.
+            persona_list = await self.services.caption_scheduler.caption(
+                self.request.body, persona_output_num
+            )
+        except InferenceQueueFullError as e:
+            self.write_busy(e)
+            return
+        except InvalidRequestError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.write_json({"persona_list": persona_list})
+
+
+class RandomPersonaHandler(InferenceHandler):
+    async def get(self):
+        persona_output_num = self.get_output_num()
+        try:
+            persona_list = await self.services.executor.run(
+                "get_random_persona_list", persona_output_num
+            )
+        except InferenceQueueFullError as e:
+            self.write_busy(e)
+            return
+        except InvalidRequestError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.write_json({"persona_list": persona_list})
+
+
+class ReplyHandler(InferenceHandler):
+    async def post(self):
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Request body must be JSON.")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, "Request body must be a JSON object.")
+        message = body.get("message")
+        history = body.get("history", [])
+        persona = body.get("persona", [])
+        if not message or not isinstance(message, str):
+            raise tornado.web.HTTPError(400, "message must be a non-empty string.")
+        if not persona or not isinstance(persona, list):
+            raise tornado.web.HTTPError(400, "persona must be a non-empty list.")
+        if not isinstance(history, list):
+            raise tornado.web.HTTPError(400, "history must be a list.")
+        # A bad element would fail the whole batch of concurrent replies.
+        if not all(isinstance(s, str) for s in persona + history):
+            raise tornado.web.HTTPError(
+                400, "persona and history must be lists of strings."
+            )
+
+        try:
+            # Replies of concurrent requests are decoded together in one batch.
+            reply, history = await self.services.reply_scheduler.reply(
+                message, history, persona
+            )
+        except InferenceQueueFullError as e:
+            self.write_busy(e)
+            return
+        except ModelNotLoadedError as e:
+            self.write_json({"error": str(e)}, status=500)
+            return
+        self.write_json({"reply": reply, "history": history})
+
+
+def make_app(services):
+    kwargs = {"services": services}
+    return tornado.web.Application(
+        [
+            (r"/healthz", HealthHandler, kwargs),
+            (r"/metrics", MetricsHandler, kwargs),
+            (r"/caption", CaptionHandler, kwargs),
+            (r"/persona/random", RandomPersonaHandler, kwargs),
+            (r"/reply", ReplyHandler, kwargs),
+        ]
+    )
+
+
+async def serve():
+    services = InferenceServices()
+    app = make_app(services)
+    # /healthz answers 503 while the models are warming up.
+    app.listen(HTTP_API_PORT, HTTP_API_LISTEN)
+    logger.info("HTTP API is listening on http://%s:%d", HTTP_API_LISTEN, HTTP_API_PORT)
+    await services.start()
+    logger.info("HTTP API is ready.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        services.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())
@@ -0,0 +1,218 @@
+"""Counters, gauges and histograms exposed in the Prometheus text format.
+
+Metrics are module-level objects registered in REGISTRY. Observations made
+in a worker process are collected with capture() and replayed into the
+registry of the serving process with replay().
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    float("inf"),
+)
+
+_capture = threading.local()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _record(self, value, labels):
+        raise NotImplementedError
+
+    def _captured(self, value, labels):
+        self._record(value, labels)
+        observations = getattr(_capture, "observations", None)
+        if observations is not None:
+            observations.append((self.name, labels, value))
+
+    def _header(self):
+        return (
+            f"# HELP {self.name} {self.documentation}\n"
+            f"# TYPE {self.name} {self.type}\n"
+        )
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [
+            f"{self.name}{_format_labels(key)} {_format_value(value)}\n"
+            for key, value in values
+        ]
+        return self._header() + "".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._captured(amount, labels)
+
+    def _record(self, value, labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    """Gauges describe the state of the process that sets them and are not captured."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(name, documentation, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self._captured(value, labels)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _record(self, value, labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total))
+                for key, (counts, total) in self._values.items()
+            )
+        lines = []
+        for key, (counts, total) in values:
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(key + (("le", _format_value(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {count}\n")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {repr(total)}\n")
+            lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}\n")
+        return self._header() + "".join(lines)
+
+
+@contextmanager
+def capture():
+    """Collects the counter and histogram observations made by this thread."""
+    previous = getattr(_capture, "observations", None)
+    _capture.observations = []
+    try:
+        yield _capture.observations
+    finally:
+        _capture.observations = previous
+
+
+def replay(observations, registry=REGISTRY):
+    for name, labels, value in observations:
+        metric = registry.get(name)
+        if metric is None:
+            logger.warning("Metric %s is not registered in this process.", name)
+            continue
+        metric._record(value, labels)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, listen="127.0.0.1"):
+    """Serves GET /metrics from a daemon thread."""
+    server = ThreadingHTTPServer((listen, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info("Metrics are served on http://%s:%d/metrics", listen, port)
+    return server
@@ -0,0 +1,128 @@
+import logging
+import os
+import time
+
+import metrics
+from caption_cache import ImageDecodeError
+from GPT2.conv_ai_model_ja import ConvAIModelJa
+from persona_captiopn import PersonaCaption
+
+logger = logging.getLogger(__name__)
+
+GPT2_MODEL_DIR = "./GPT2/model/"
+
+DIALOGUE_BATCH_SECONDS = metrics.Histogram(
+    "dialogue_batch_seconds", "Latency of one GPT2 reply generation batch."
+)
+DIALOGUE_BATCH_SIZE = metrics.Histogram(
+    "dialogue_batch_size",
+    "Number of replies generated in one GPT2 batch.",
+    buckets=(1, 2, 4, 8, 16, 32, float("inf")),
+)
+
+
+class ModelNotLoadedError(Exception):
+    pass
+
+
+class InvalidRequestError(Exception):
+    pass
+
+
+class ModelContext:
+    """Holds warm model instances shared by every request of the process."""
+
+    def __init__(self, conv_ai_params, gpt2_model_dir=GPT2_MODEL_DIR):
+        logger.info("Loading persona caption models...")
+        self.persona_caption = PersonaCaption()
+
+        self.conv_ai_model = None
+        if os.path.isfile(os.path.join(gpt2_model_dir, "pytorch_model.bin")):
+            logger.info("Loading GPT2 model...")
+            self.conv_ai_model = ConvAIModelJa(gpt2_model_dir, args=conv_ai_params)
+        else:
+            logger.error(
+                "GPT2 model file pytorch_model.bin is not placed under %s",
+                gpt2_model_dir,
+            )
+        logger.info("Successfully load all models.")
+        self.ready = False
+
+    def get_persona_list(self, image, persona_output_num):
+        self._check_output_num(persona_output_num)
+        try:
+            return self.persona_caption.get_persona_list(image, persona_output_num)
+        except ImageDecodeError as e:
+            raise InvalidRequestError(str(e)) from e
+
+    def get_persona_lists(self, images, persona_output_num):
+        return self.persona_caption.get_persona_lists(images, persona_output_num)
+
+    def caption_batch(self, images, persona_output_nums):
+        """Returns the persona list of each image with its own number of personas.
+
+        A request with an invalid number or image gets its InvalidRequestError
+        in place of its persona list, without failing the other requests.
+        """
+        results = [None] * len(images)
+        requests_by_num = {}
+        for i, persona_output_num in enumerate(persona_output_nums):
+            try:
+                self._check_output_num(persona_output_num)
+            except InvalidRequestError as e:
+                results[i] = e
+            else:
+                requests_by_num.setdefault(persona_output_num, []).append(i)
+        for persona_output_num, indices in requests_by_num.items():
+            persona_lists = self.persona_caption.get_persona_lists(
+                [images[i] for i in indices], persona_output_num
+            )
+            for i, persona_list in zip(indices, persona_lists):
+                if isinstance(persona_list, ImageDecodeError):
+                    persona_list = InvalidRequestError(str(persona_list))
+                results[i] = persona_list
+        return results
+
+    def get_random_persona_list(self, persona_output_num):
+        self._check_output_num(persona_output_num)
+        return self.persona_caption.get_random_persona_list(persona_output_num)
+
+    def _check_output_num(self, persona_output_num):
+        persona_count = self.persona_caption.persona_count()
+        if not 1 <= persona_output_num <= persona_count:
+            raise InvalidRequestError(f"n must be between 1 and {persona_count}.")
+
+    def reply_batch(self, messages, histories, personalities):
+        if self.conv_ai_model is None:
+            raise ModelNotLoadedError("GPT2 model is not loaded.")
+        with DIALOGUE_BATCH_SECONDS.time():
+            results = self.conv_ai_model.interact_batch(
+                messages, histories, personalities
+            )
+        DIALOGUE_BATCH_SIZE.observe(len(messages))
+        return results
+
+    def warm_up(self, persona_output_num=5):
+        """Runs a synthetic image and message through the whole pipeline once.
+
+        The first FRCNN forward, VL-T5 generation, ginza parse, chiVe access and
+        GPT2 decode are slow, so they are paid here instead of by the first user.
+        """
+        logger.info("Warming up models...")
+        persona_list, timings = self.persona_caption.warm_up(persona_output_num)
+        if self.conv_ai_model is not None:
+            persona_count = self.persona_caption.persona_count()
+            if not persona_list and persona_count:
+                # An empty personality makes ConvAIModel download its dataset.
+                persona_list = self.get_random_persona_list(
+                    min(persona_output_num, persona_count)
+                )
+            # The dialogue is not warmed up while the persona store is empty.
+            if persona_list:
+                started = time.perf_counter()
+                self.conv_ai_model.interact_batch(["こんにちは"], [[]], [persona_list])
+                timings["dialogue"] = time.perf_counter() - started
+        for stage, seconds in timings.items():
+            logger.info("Warm-up of %s took %.3fs.", stage, seconds)
+        self.ready = True
+        return timings
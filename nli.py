@@ -2,26 +2,43 @@ from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import torch
 import numpy as np
 
+NLI_MODEL = "Formzu/bert-base-japanese-jsnli"
+
 
 class BertNLI:
-    def __init__(
-        self, model_name_or_path="Formzu/bert-base-japanese-jsnli", device=None
-    ):
+    def __init__(self, model_name_or_path=NLI_MODEL, device=None):
+        self.model_name_or_path = model_name_or_path
         if device is None:
             self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.nli = AutoModelForSequenceClassification.from_pretrained(
             model_name_or_path
         ).to(self.device)
+        self.nli.eval()
         self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
         self.label_map = {0: "entailment", 1: "neutral", 2: "contradiction"}
 
-    @torch.no_grad()
     def predict(self, premise, hypothesis):
-        input = self.tokenizer.encode(premise, hypothesis, return_tensors="pt").to(
-            self.device
-        )
-        logits = self.nli(input)["logits"][0]
-        probs = logits.softmax(dim=-1)
-        probs = probs.cpu().numpy()
-        label = self.label_map[np.argmax(probs, axis=0)]
-        return label
+        return self.predict_batch([(premise, hypothesis)])[0]
+
+    @torch.no_grad()
+    def predict_batch(self, pairs, batch_size=32):
+        """Returns the labels of (premise, hypothesis) pairs.
+
+        Each batch is padded only to its longest pair, and the pairs are sorted
+        by length so that pairs of similar length share a batch.
+        """
+        order = sorted(range(len(pairs)), key=lambda i: sum(map(len, pairs[i])))
+        labels = [None] * len(pairs)
+        for start in range(0, len(order), batch_size):
+            batch = order[start : start + batch_size]
+            inputs = self.tokenizer(
+                [pairs[i][0] for i in batch],
+                [pairs[i][1] for i in batch],
+                padding=True,
+                return_tensors="pt",
+            ).to(self.device)
+            logits = self.nli(**inputs)["logits"]
+            probs = logits.softmax(dim=-1).cpu().numpy()
+            for i, label_id in zip(batch, np.argmax(probs, axis=-1)):
+                labels[i] = self.label_map[int(label_id)]
+        return labels
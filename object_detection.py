@@ -8,17 +8,26 @@ import spacy
 
 logger = logging.getLogger(__name__)
 
+OBJECTS_VOCAB = "./VLT5/VG/objects_vocab.txt"
+
+
+def load_object_labels(path=OBJECTS_VOCAB):
+    """Returns the object labels of the Visual Genome classes in class id order."""
+    labels = []
+    with open(path) as f:
+        for obj in f.readlines():
+            obj = unicodedata.normalize("NFKC", obj)
+            labels.append(obj.split(",")[0].lower().strip())
+    return labels
+
 
 class ObjectDetection:
     def __init__(self, model_name_or_path="unc-nlp/frcnn-vg-finetuned", device=None):
+        self.model_name_or_path = model_name_or_path
         if device is None:
             self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
-        self.obj_ids = []
-        with open("./VLT5/VG/objects_vocab.txt") as f:
-            for obj in f.readlines():
-                obj = unicodedata.normalize("NFKC", obj)
-                self.obj_ids.append(obj.split(",")[0].lower().strip())
+        self.obj_ids = load_object_labels()
 
         self.frcnn_cfg = Config.from_pretrained(model_name_or_path)
         self.frcnn = GeneralizedRCNN.from_pretrained(
@@ -26,9 +35,15 @@ class ObjectDetection:
         )
         self.frcnn.to(self.device)
 
-    def detection(self, image_path):
+    def detection(self, image):
+        """image is a file path, encoded image bytes, PIL image or BGR numpy array."""
+        return self.detection_batch([image])
+
+    def detection_batch(self, images):
+        """Detects the objects of a list of images in one forward pass."""
         image_preprocess = Preprocess(self.frcnn_cfg)
-        images, sizes, scales_yx = image_preprocess(image_path)
+        # Preprocess replaces the items of the list it is given.
+        images, sizes, scales_yx = image_preprocess(list(images))
         images = images.to(self.device)
 
         output_dict = self.frcnn(
@@ -42,9 +57,9 @@ class ObjectDetection:
         logger.info("Successfully detect objects in the photo.")
         return output_dict
 
-    def get_object_labels(self, output_dict):
+    def get_object_labels(self, output_dict, image_index=0):
         labels = []
-        for id in output_dict.get("obj_ids")[0]:
+        for id in output_dict.get("obj_ids")[image_index]:
             labels.append(self.obj_ids[id])
         labels = list(set(labels))
         logger.info("Successfully get object labels in the photo. labels = %s", labels)
@@ -1,52 +1,269 @@
-import glob
 import logging
-import os
 import random
-import scipy.spatial
-from nli import BertNLI
-from object_detection import ObjectDetection
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import metrics
+from caption_cache import (
+    CaptionCache,
+    ImageDecodeError,
+    config_fingerprint,
+    decode_image,
+)
+from nli import NLI_MODEL, BertNLI
+from object_detection import OBJECTS_VOCAB, ObjectDetection
+from persona_index import (
+    PERSONA_CSV,
+    file_fingerprint,
+    load_contradiction_matrix,
+    load_persona_data,
+    load_persona_embeddings,
+    load_persona_index,
+    load_query_embeddings,
+    normalize,
+)
+from persona_store import (
+    PERSONA_STORE_COMPACT_RATIO,
+    PERSONA_STORE_POLL_SECONDS,
+    PersonaStore,
+)
 from sentence_bert import SentenceBertJapanese
+from synonym import ChiveSynonyms
 from vqa import Vqa
-from gensim.models import KeyedVectors
 
 logger = logging.getLogger(__name__)
 
+# Number of top personas ranked by _search for the persona selection.
+SEARCH_TOP_K = 128
+# Number of synonyms of each query added by _expand_queries.
+SYNONYM_TOPN = 5
+# Number of images detected in one FRCNN forward pass by get_persona_lists.
+DETECTION_BATCH_SIZE = 8
+
+STAGE_SECONDS = metrics.Histogram(
+    "persona_caption_stage_seconds",
+    "Latency of each stage of PersonaCaption.get_persona_list.",
+)
+BATCH_STAGE_SECONDS = metrics.Histogram(
+    "persona_caption_batch_stage_seconds",
+    "Latency of each stage of PersonaCaption.get_persona_lists for all its images.",
+)
+BATCH_IMAGES = metrics.Counter(
+    "persona_caption_batch_images_total",
+    "Images captioned by PersonaCaption.get_persona_lists.",
+)
+CORPUS_RELOADS = metrics.Counter(
+    "persona_caption_corpus_reloads_total",
+    "Persona corpus versions loaded from the persona store by PersonaCaption.",
+)
+
+
+class PersonaCorpus:
+    """The personas searched by PersonaCaption at one version.
+
+    Row i of the embeddings is sentences[i]. Rows deleted from the persona
+    store are kept until its compaction and are masked by live.
+    """
+
+    def __init__(
+        self,
+        version,
+        sentences,
+        labels,
+        embeddings,
+        index,
+        contradictions=None,
+        live=None,
+    ):
+        self.version = version
+        self.sentences = sentences
+        self.embeddings = embeddings
+        self.index = index
+        self.contradictions = contradictions
+        self.live = np.ones(len(sentences), dtype=bool) if live is None else live
+        self.deleted = int(len(sentences) - self.live.sum())
+        self.persona_data = {
+            s: l for s, l, live in zip(sentences, labels, self.live) if live
+        }
+        self.persona_ids = {s: i for i, s in enumerate(sentences) if self.live[i]}
+        # Set by PersonaCaption to the config of the cached persona lists.
+        self.config = None
+
 
 class PersonaCaption:
     def __init__(self):
         self.model = SentenceBertJapanese()
-
-        self.persona_data = {}
-        with open("./data/persona_list.csv") as f:
-            for i, text in enumerate(f):
-                if i == 0:
-                    continue
-                print(i, "...", end="\r")
-                persona = text.split(",")
-                desc = persona[1].strip()
-                label = persona[2].strip()
-                self.persona_data[desc] = label
-
-    def _get_query_list(self, image_path):
-        object_detection = ObjectDetection()
-
-        output = object_detection.detection(image_path)
-        object_labels = object_detection.get_object_labels(output)
-        normalized_boxes, roi_features = object_detection.get_object_features_for_vlt5(
-            output
+        # The object labels and their synonyms are never encoded at request time.
+        queries, query_embeddings = load_query_embeddings(
+            OBJECTS_VOCAB, self.model.model_name_or_path
         )
+        if queries:
+            self.model.pin(queries, query_embeddings)
+        self.object_detection = ObjectDetection()
+        self.vqa = Vqa()
+        self.synonyms = ChiveSynonyms()
 
-        vqa = Vqa(normalize_boxes=normalized_boxes, roi_features=roi_features)
-        questions = []
         with open("./data/vqa_questions.txt") as f:
-            for question in f.readlines():
-                questions.append(question)
-        vqa_answers = vqa.get_answer(questions)
+            self.questions = f.readlines()
+
+        # Each stage result is cached under the config of the stages up to it.
+        self.cache = CaptionCache()
+        self.detection_config = config_fingerprint(
+            self.object_detection.model_name_or_path
+        )
+        self.vqa_config = config_fingerprint(
+            self.detection_config, self.vqa.model_name_or_path, *self.questions
+        )
+
+        # The personas come from the persona store if it is built, and from the
+        # persona CSV otherwise.
+        self.store = PersonaStore()
+        self.nli = None
+        if self.store.exists():
+            self.corpus = self._load_store_corpus()
+            threading.Thread(
+                target=self._watch_store, name="persona-store-watcher", daemon=True
+            ).start()
+        else:
+            self.corpus = self._load_csv_corpus()
+            if self.corpus.contradictions is None:
+                logger.warning(
+                    "Persona contradictions are not built, so NLI runs per request. "
+                    "Build them with `python persona_index.py contradictions`."
+                )
+                self.nli = BertNLI()
+
+    def _load_csv_corpus(self):
+        persona_data = load_persona_data(PERSONA_CSV)
+        sentences = list(persona_data.keys())
+        # The persona corpus does not change between requests, so it is encoded once.
+        embeddings = load_persona_embeddings(PERSONA_CSV, sentences, self.model)
+        corpus = PersonaCorpus(
+            file_fingerprint(PERSONA_CSV),
+            sentences,
+            list(persona_data.values()),
+            embeddings,
+            load_persona_index(PERSONA_CSV, self.model.model_name_or_path, embeddings),
+            # The NLI model is only loaded if the contradictions are not precomputed.
+            load_contradiction_matrix(PERSONA_CSV, len(sentences), NLI_MODEL),
+        )
+        corpus.config = self._persona_config(corpus)
+        return corpus
+
+    def _load_store_corpus(self):
+        snapshot = self.store.snapshot()
+        if snapshot.model_name != self.model.model_name_or_path:
+            raise ValueError(
+                f"The persona store is encoded with {snapshot.model_name}, "
+                f"not {self.model.model_name_or_path}."
+            )
+        corpus = PersonaCorpus(
+            snapshot.version,
+            snapshot.sentences,
+            snapshot.labels,
+            snapshot.embeddings,
+            # Both are kept up to date by the writers of the store.
+            snapshot.index,
+            snapshot.contradictions,
+            live=snapshot.live,
+        )
+        if corpus.contradictions is None and self.nli is None:
+            # Loaded before the corpus is swapped in, so never by a request.
+            logger.warning(
+                "The persona store keeps no contradictions, so NLI runs per request."
+            )
+            self.nli = BertNLI()
+        corpus.config = self._persona_config(corpus)
+        logger.info(
+            "Loaded persona store version %s with %d personas (%d deleted)",
+            corpus.version,
+            len(corpus.persona_data),
+            corpus.deleted,
+        )
+        return corpus
 
-        return object_labels, vqa_answers
+    def _persona_config(self, corpus):
+        return config_fingerprint(
+            self.vqa_config,
+            corpus.version,
+            self.model.model_name_or_path,
+            self.synonyms.version,
+            corpus.contradictions is None,
+            corpus.index.kind,
+            SEARCH_TOP_K,
+            SYNONYM_TOPN,
+        )
+
+    def _watch_store(self):
+        """Swaps in each new version of the persona store without a restart.
+
+        Requests capture self.corpus once, so they finish on the version they
+        started with. The store is compacted here once enough rows are deleted.
+        """
+        while True:
+            time.sleep(PERSONA_STORE_POLL_SECONDS)
+            try:
+                if self.store.version() != self.corpus.version:
+                    self.corpus = self._load_store_corpus()
+                    CORPUS_RELOADS.inc()
+                if self.corpus.deleted:
+                    # The new version is picked up by the next poll.
+                    self.store.compact(PERSONA_STORE_COMPACT_RATIO)
+            except Exception:
+                logger.exception("Failed to reload the persona store")
 
-    def _get_query_score_dict(self, image_path, output_size=5):
-        object_labels, vqa_answers = self._get_query_list(image_path)
+    def _detect(self, image):
+        object_labels, normalized_boxes, roi_features = self._detect_batch([image])
+        return object_labels[0], normalized_boxes, roi_features
+
+    def _decode_images(self, images):
+        """Returns the decoded images, their hashes and {position: ImageDecodeError}.
+
+        Each image is decoded on its own, so one unreadable image does not fail
+        the batch it would have been detected with.
+        """
+        decoded = []
+        hashes = []
+        failed = {}
+        for i, image in enumerate(images):
+            try:
+                image, image_hash = decode_image(image)
+            except ImageDecodeError as e:
+                logger.warning("Image %d of the batch was skipped: %s", i, e)
+                failed[i] = e
+                continue
+            decoded.append(image)
+            hashes.append(image_hash)
+        return decoded, hashes, failed
+
+    def _detect_batch(self, images):
+        if not images:
+            return [], None, None
+        output = self.object_detection.detection_batch(images)
+        object_labels = [
+            self.object_detection.get_object_labels(output, i)
+            for i in range(len(images))
+        ]
+        (
+            normalized_boxes,
+            roi_features,
+        ) = self.object_detection.get_object_features_for_vlt5(output)
+        return object_labels, normalized_boxes, roi_features
+
+    def _answer(self, normalized_boxes, roi_features):
+        return self.vqa.get_answer(self.questions, normalized_boxes, roi_features)
+
+    def _answer_batch(self, normalized_boxes, roi_features):
+        if roi_features is None:
+            return []
+        return self.vqa.get_answers(self.questions, normalized_boxes, roi_features)
+
+    def _expand_queries(
+        self, object_labels, vqa_answers, output_size=SYNONYM_TOPN, synonyms=None
+    ):
+        """synonyms is the result of most_similar_batch over the queries, if known."""
         # If there are duplicate query in object labels and vqa answers,
         # remove them from vqa answers.
         for label in object_labels:
@@ -58,84 +275,287 @@ class PersonaCaption:
         vqa_answers_score_dict = {v: 0.9 for v in vqa_answers}
         query_score_dict = {**object_labels_score_dict, **vqa_answers_score_dict}
 
-        if not os.path.exists("./data/chive"):
-            logger.error("chiVe vector is not placed under ./data/chive")
-
-        kv_file = glob.glob("./data/chive/*.kv")
-        npy_file = glob.glob("./data/chive/*.npy")
-        if not kv_file or not npy_file:
-            logger.error(
-                "chiVe vector .kv or .npy file is not placed under ./data/chive"
+        if synonyms is None:
+            # All the queries are expanded in one pass over chiVe.
+            synonyms = self.synonyms.most_similar_batch(
+                list(query_score_dict.keys()), topn=output_size
             )
-            logger.warn("Could not extract synonyms.")
-            return query_score_dict
-
-        word2vec_model = KeyedVectors.load(kv_file[0])
         for query in list(query_score_dict.keys()):
-            if query in word2vec_model:
-                for sim in word2vec_model.most_similar(query, topn=output_size):
-                    synonym = sim[0]
-                    cos_sim = round(float(sim[1]), 3)
-                    # The score of synonym is the product of the cos similarity value and the query score.
-                    synonym_score = round(float(cos_sim * query_score_dict[query]), 3)
-                    if synonym not in query_score_dict or (
-                        synonym in query_score_dict
-                        and synonym_score > query_score_dict[synonym]
-                    ):
-                        query_score_dict[synonym] = synonym_score
+            for synonym, sim in synonyms.get(query, []):
+                cos_sim = round(sim, 3)
+                # The score of synonym is the product of the cos similarity value and the query score.
+                synonym_score = round(float(cos_sim * query_score_dict[query]), 3)
+                if synonym not in query_score_dict or (
+                    synonym in query_score_dict
+                    and synonym_score > query_score_dict[synonym]
+                ):
+                    query_score_dict[synonym] = synonym_score
         logger.info("Successfully build query score dict. dict = %s", query_score_dict)
         return query_score_dict
 
-    def _search(self, query_score_dict, distance_threshold=1):
+    def _search(self, corpus, query_score_dict, distance_threshold=1, top_k=None):
+        """Returns (persona, score) of the top_k personas (all if None) by score."""
+        return self._search_batch(
+            corpus, [query_score_dict], distance_threshold, top_k
+        )[0]
+
+    def _search_batch(
+        self, corpus, query_score_dicts, distance_threshold=1, top_k=None
+    ):
+        """Searches for each query score dict, encoding the union of their queries once."""
         logger.info("Searching...")
-        search_queries = list(query_score_dict.keys())
-        persona_sentences = list(self.persona_data.keys())
-        sentence_vectors = self.model.encode(persona_sentences)
-        query_embeddings = self.model.encode(search_queries).numpy()
-
-        search_result = {}
-        for query, query_embedding in zip(search_queries, query_embeddings):
-            query_score = query_score_dict[query]
-            # cos_distance = 1- cos_similarity
-            distances = scipy.spatial.distance.cdist(
-                [query_embedding], sentence_vectors, metric="cosine"
-            )[0]
-
-            results = zip(range(len(distances)), distances)
-            # sort by cos_distance ascending
-            results = sorted(results, key=lambda x: x[1])
-            for idx, distance in results:
-                if distance < distance_threshold:
-                    persona_sentence = persona_sentences[idx]
-                    persona_score = self._get_persona_score(query_score, distance)
-                    if persona_sentence not in search_result or (
-                        persona_sentence in search_result
-                        and persona_score > search_result[persona_sentence]
-                    ):
-                        # Add score to each persona.
-                        search_result[persona_sentence] = persona_score
-        search_result = sorted(search_result.items(), key=lambda x: x[1], reverse=True)
-        logger.info(
-            "Successfully search by queries. Top 30 search result = %s",
-            search_result[:30],
-        )
-        return search_result
+        search_queries = list(dict.fromkeys(q for d in query_score_dicts for q in d))
+        if not search_queries:
+            return [[] for _ in query_score_dicts]
+        query_ids = {query: i for i, query in enumerate(search_queries)}
+        query_embeddings = normalize(self.model.encode(search_queries).numpy())
+        if top_k is not None:
+            # The top_k personas by score are among the top_k personas by
+            # similarity of some query, since the score of a persona grows with
+            # its similarity to each query.
+            # Deleted personas are masked inside the index.
+            _, nearest_ids = corpus.index.top_k(
+                query_embeddings, top_k, corpus.live if corpus.deleted else None
+            )
+
+        search_results = []
+        for query_score_dict in query_score_dicts:
+            if not query_score_dict:
+                search_results.append([])
+                continue
+            rows = [query_ids[q] for q in query_score_dict]
+            if top_k is not None:
+                candidate_ids = np.unique(nearest_ids[rows])
+                candidate_ids = candidate_ids[candidate_ids >= 0]
+            else:
+                candidate_ids = np.flatnonzero(corpus.live)
+            # cos_distance = 1- cos_similarity, for every (query, candidate) pair.
+            # The persona embeddings are already unit-normalized.
+            distances = 1 - query_embeddings[rows] @ corpus.embeddings[candidate_ids].T
+            query_scores = np.array(list(query_score_dict.values()), dtype=np.float32)
+            scores = self._get_persona_score(query_scores[:, None], distances)
+            scores = np.where(distances < distance_threshold, scores, -np.inf)
+            # Each persona takes the score of its best query.
+            persona_scores = scores.max(axis=0)
+
+            candidates = np.flatnonzero(persona_scores > -np.inf)
+            if top_k is not None and top_k < len(candidates):
+                top = np.argpartition(-persona_scores[candidates], top_k - 1)[:top_k]
+                candidates = candidates[top]
+            order = np.argsort(-persona_scores[candidates], kind="stable")
+            search_result = [
+                (
+                    corpus.sentences[candidate_ids[idx]],
+                    float(persona_scores[idx]),
+                )
+                for idx in candidates[order]
+            ]
+            logger.info(
+                "Successfully search by queries. Top 30 search result = %s",
+                search_result[:30],
+            )
+            search_results.append(search_result)
+        return search_results
 
     def _get_persona_score(self, query_score, distance):
         return query_score / (distance + 1)
 
-    def get_persona_list(self, image_path, persona_output_num):
-        query_score_dict = self._get_query_score_dict(image_path)
-        search_result = self._search(query_score_dict)
-        persona_list = []
-        label_result = []
+    def get_persona_list(self, image, persona_output_num):
+        persona_list, timings = self._run_stages(image, persona_output_num)
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        return persona_list
+
+    def _run_stages(self, image, persona_output_num, cache=None):
+        timings = {}
+        cache = self.cache if cache is None else cache
+        # The whole request uses the persona corpus current at its start.
+        corpus = self.corpus
+        # The image is decoded once, both for its hash and for the detection.
+        image, image_hash = decode_image(image)
+        persona_key = f"{corpus.config}:{persona_output_num}:{image_hash}"
+        persona_list = cache.get("personas", persona_key)
+        if persona_list is not None:
+            return list(persona_list), timings
+
+        detection_key = f"{self.detection_config}:{image_hash}"
+        detection = cache.get("detection", detection_key)
+        if detection is None:
+            with _timed(timings, "detection"):
+                detection = self._detect(image)
+            cache.put("detection", detection_key, detection)
+        object_labels, normalized_boxes, roi_features = detection
+
+        vqa_key = f"{self.vqa_config}:{image_hash}"
+        vqa_answers = cache.get("vqa", vqa_key)
+        if vqa_answers is None:
+            with _timed(timings, "vqa"):
+                vqa_answers = self._answer(normalized_boxes, roi_features)
+            cache.put("vqa", vqa_key, vqa_answers)
+
+        with _timed(timings, "synonyms"):
+            # _expand_queries removes items from its arguments.
+            query_score_dict = self._expand_queries(
+                list(object_labels), list(vqa_answers)
+            )
+        with _timed(timings, "search"):
+            search_result = self._search(corpus, query_score_dict, top_k=SEARCH_TOP_K)
+        with _timed(timings, "selection"):
+            persona_list = self._select(
+                corpus, query_score_dict, search_result, persona_output_num
+            )
+        cache.put("personas", persona_key, list(persona_list))
+        return persona_list, timings
+
+    def get_persona_lists(
+        self, images, persona_output_num, batch_size=DETECTION_BATCH_SIZE
+    ):
+        """Returns the persona list of each image, running each stage on many images.
+
+        Detection and VQA run on batch_size images at a time, and the queries of
+        all the images are expanded and encoded together. An image that cannot be
+        decoded gets its ImageDecodeError in place of its persona list.
+        """
+        persona_lists, timings = self._run_stages_batch(
+            images, persona_output_num, batch_size
+        )
+        for stage, seconds in timings.items():
+            BATCH_STAGE_SECONDS.observe(seconds, stage=stage)
+        BATCH_IMAGES.inc(len(images))
+        return persona_lists
+
+    def _run_stages_batch(
+        self, images, persona_output_num, batch_size=DETECTION_BATCH_SIZE
+    ):
+        timings = {}
+        corpus = self.corpus
+        with _timed(timings, "detection"):
+            images, hashes, failed = self._decode_images(images)
+        # Images captioned before under the same config are not run again.
+        persona_keys = [f"{corpus.config}:{persona_output_num}:{h}" for h in hashes]
+        persona_lists = [self.cache.get("personas", key) for key in persona_keys]
+        misses = [
+            i for i, persona_list in enumerate(persona_lists) if persona_list is None
+        ]
+        images = [images[i] for i in misses]
+        object_labels = []
+        vqa_answers = []
+        for start in range(0, len(images), batch_size):
+            with _timed(timings, "detection"):
+                labels, normalized_boxes, roi_features = self._detect_batch(
+                    images[start : start + batch_size]
+                )
+            with _timed(timings, "vqa"):
+                answers = self._answer_batch(normalized_boxes, roi_features)
+            object_labels.extend(labels)
+            vqa_answers.extend(answers)
+        with _timed(timings, "synonyms"):
+            query_score_dicts = self._expand_queries_batch(object_labels, vqa_answers)
+        with _timed(timings, "search"):
+            search_results = self._search_batch(
+                corpus, query_score_dicts, top_k=SEARCH_TOP_K
+            )
+        with _timed(timings, "selection"):
+            for i, query_score_dict, search_result in zip(
+                misses, query_score_dicts, search_results
+            ):
+                persona_lists[i] = self._select(
+                    corpus, query_score_dict, search_result, persona_output_num
+                )
+                self.cache.put("personas", persona_keys[i], list(persona_lists[i]))
+        return _with_failures([list(p) for p in persona_lists], failed), timings
+
+    def _expand_queries_batch(self, object_labels, vqa_answers):
+        # The queries of all the images are expanded in one pass over chiVe.
+        queries = [q for qs in object_labels + vqa_answers for q in qs]
+        synonyms = self.synonyms.most_similar_batch(queries, topn=SYNONYM_TOPN)
+        return [
+            self._expand_queries(labels, answers, synonyms=synonyms)
+            for labels, answers in zip(object_labels, vqa_answers)
+        ]
+
+    def pipeline_stages(self, persona_output_num):
+        """Returns (name, function) of the stages of get_persona_lists in order.
+
+        Each function takes the dict of one batch of images, starting as
+        {"images": [...]}, replaces its inputs with its results and leaves
+        "persona_lists" at the end. The images that cannot be decoded are left
+        out of "persona_lists", and their errors are put in "failed" by position.
+        """
+
+        def detection(batch):
+            images, _, batch["failed"] = self._decode_images(batch.pop("images"))
+            (
+                batch["object_labels"],
+                batch["normalized_boxes"],
+                batch["roi_features"],
+            ) = self._detect_batch(images)
+
+        def vqa(batch):
+            batch["vqa_answers"] = self._answer_batch(
+                batch.pop("normalized_boxes"), batch.pop("roi_features")
+            )
+
+        def synonyms(batch):
+            batch["query_score_dicts"] = self._expand_queries_batch(
+                batch.pop("object_labels"), batch.pop("vqa_answers")
+            )
+
+        def search(batch):
+            # The selection uses the persona corpus that was searched.
+            batch["corpus"] = self.corpus
+            batch["search_results"] = self._search_batch(
+                batch["corpus"], batch["query_score_dicts"], top_k=SEARCH_TOP_K
+            )
+
+        def selection(batch):
+            corpus = batch.pop("corpus")
+            batch["persona_lists"] = [
+                self._select(
+                    corpus, query_score_dict, search_result, persona_output_num
+                )
+                for query_score_dict, search_result in zip(
+                    batch.pop("query_score_dicts"), batch.pop("search_results")
+                )
+            ]
+
+        return [
+            ("detection", detection),
+            ("vqa", vqa),
+            ("synonyms", synonyms),
+            ("search", search),
+            ("selection", selection),
+        ]
+
+    def _select(self, corpus, query_score_dict, search_result, persona_output_num):
+        persona_list = self._select_personas(corpus, search_result, persona_output_num)
+        top_k = SEARCH_TOP_K
+        examined = set()
+        # The top personas were mostly duplicates or contradictions, so the
+        # selection continues with the next page of the ranking, doubling the
+        # number of personas fetched from the index until the ranking runs out.
+        while len(persona_list) < persona_output_num and len(search_result) == top_k:
+            examined.update(persona for persona, _ in search_result)
+            top_k *= 2
+            search_result = self._search(corpus, query_score_dict, top_k=top_k)
+            rest = [result for result in search_result if result[0] not in examined]
+            persona_list = self._select_personas(
+                corpus, rest, persona_output_num, persona_list
+            )
+        return persona_list
+
+    def _select_personas(
+        self, corpus, search_result, persona_output_num, persona_list=None
+    ):
+        persona_list = list(persona_list or [])
+        label_result = [corpus.persona_data[persona] for persona in persona_list]
 
         for result in search_result:
             new_persona = result[0]
             # Skip if the persona category duplicates or contradicts any of the previous personas.
-            label = self.persona_data[new_persona]
+            label = corpus.persona_data[new_persona]
             if (label != "その他" and label in label_result) or self._is_contradiction(
-                persona_list, new_persona
+                corpus, persona_list, new_persona
             ):
                 logger.info(
                     "Persona 「%s」 were skipped without adding to persona list.",
@@ -152,10 +572,23 @@ class PersonaCaption:
         )
         return persona_list
 
-    def _is_contradiction(self, persona_list, new_persona):
-        nli = BertNLI()
-        for persona in persona_list:
-            if nli.predict(persona, new_persona) == "contradiction":
+    def _is_contradiction(self, corpus, persona_list, new_persona):
+        if not persona_list:
+            return False
+        if corpus.contradictions is not None:
+            new_id = corpus.persona_ids[new_persona]
+            contradicts = [
+                corpus.contradictions.contradicts(corpus.persona_ids[persona], new_id)
+                for persona in persona_list
+            ]
+        else:
+            # The pairs against all the accepted personas are run in one batch.
+            labels = self.nli.predict_batch(
+                [(persona, new_persona) for persona in persona_list]
+            )
+            contradicts = [label == "contradiction" for label in labels]
+        for persona, contradiction in zip(persona_list, contradicts):
+            if contradiction:
                 logger.info(
                     "Persona 「%s」 contradicts 「%s」 in persona list",
                     new_persona,
@@ -164,5 +597,33 @@ class PersonaCaption:
                 return True
         return False
 
+    def persona_count(self):
+        return len(self.corpus.persona_data)
+
     def get_random_persona_list(self, persona_output_num):
-        return random.sample(list(self.persona_data.keys()), persona_output_num)
+        return random.sample(list(self.corpus.persona_data.keys()), persona_output_num)
+
+    def warm_up(self, persona_output_num=5):
+        """Runs a synthetic image through every stage and returns the stage timings."""
+        # Random noise in the BGR order of cv2.imread.
+        image = np.random.default_rng(0).integers(
+            0, 256, size=(480, 640, 3), dtype=np.uint8
+        )
+        # Warm-up timings are not recorded as metrics, and every stage runs even
+        # if the results of an earlier process are on disk.
+        return self._run_stages(image, persona_output_num, cache=CaptionCache(0, None))
+
+
+def _with_failures(results, failed):
+    """Puts the errors of {position: error} back between the results."""
+    size = len(results) + len(failed)
+    results = iter(results)
+    return [failed[i] if i in failed else next(results) for i in range(size)]
+
+
+@contextmanager
+def _timed(timings, stage):
+    started = time.perf_counter()
+    yield
+    # Stages run once per batch of images are summed up.
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
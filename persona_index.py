@@ -0,0 +1,524 @@
+"""Precomputed data of the persona corpus and the queries stored under data/.
+
+# Run NLI over all the ordered persona pairs once.
+python persona_index.py contradictions
+# Encode the object labels and their chiVe synonyms once.
+python persona_index.py queries
+# Build the approximate persona index and compare its recall and latency.
+python persona_index.py build --kind ivf --lists 1024
+python persona_index.py bench --kind ivf --nprobe 1 4 16 64
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PERSONA_CSV = "./data/persona_list.csv"
+PERSONA_INDEX = os.environ.get("PERSONA_INDEX", "exact")
+PERSONA_INDEX_NPROBE = int(os.environ.get("PERSONA_INDEX_NPROBE", 16))
+# Rows of the persona embeddings multiplied at once by the indexes.
+CHUNK_SIZE = 65536
+
+
+def file_fingerprint(path, *parts):
+    """Returns a short hash of the file contents and the given strings."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    for part in parts:
+        sha.update(b"\0" + str(part).encode())
+    return sha.hexdigest()[:16]
+
+
+def save_array(path, array):
+    # Written to a temporary file first so that readers never see a partial file.
+    # The name is unique, since every worker process may build it on a cold start.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.clip(norms, 1e-12, None)
+
+
+def load_persona_data(csv_path):
+    """Returns {persona description: label} of the persona CSV."""
+    persona_data = {}
+    with open(csv_path) as f:
+        for i, text in enumerate(f):
+            if i == 0:
+                continue
+            persona = text.split(",")
+            desc = persona[1].strip()
+            label = persona[2].strip()
+            persona_data[desc] = label
+    return persona_data
+
+
+def load_persona_embeddings(csv_path, sentences, model):
+    """Loads the persona embeddings stored next to the persona CSV.
+
+    The file is keyed by the CSV contents and the SentenceBERT model name, and
+    is encoded once if it does not exist yet. The embeddings are unit-normalized
+    and memory-mapped read-only.
+    """
+    key = file_fingerprint(csv_path, model.model_name_or_path)
+    path = os.path.join(os.path.dirname(csv_path), f"persona_embeddings.{key}.npy")
+    if os.path.exists(path):
+        embeddings = np.load(path, mmap_mode="r")
+        if embeddings.shape[0] == len(sentences):
+            logger.info("Loaded persona embeddings from %s", path)
+            return embeddings
+        logger.warning("%s does not match the persona list. Re-encoding.", path)
+
+    logger.info("Encoding %d personas into %s", len(sentences), path)
+    save_array(path, normalize(model.encode(sentences, use_cache=False).numpy()))
+    return np.load(path, mmap_mode="r")
+
+
+def query_embeddings_path(vocab_path, model_name, data_dir="./data"):
+    key = file_fingerprint(vocab_path, model_name)
+    return os.path.join(data_dir, f"query_embeddings.{key}.npy")
+
+
+def load_query_embeddings(vocab_path, model_name, data_dir="./data"):
+    """Returns (queries, embeddings) precomputed for the object labels, or ([], None)."""
+    path = query_embeddings_path(vocab_path, model_name, data_dir)
+    words_path = f"{path}.txt"
+    if not os.path.exists(path) or not os.path.exists(words_path):
+        logger.info(
+            "Query embeddings are not built. "
+            "Build them with `python persona_index.py queries`."
+        )
+        return [], None
+    with open(words_path, encoding="utf-8") as f:
+        queries = f.read().split("\n")
+    embeddings = np.load(path, mmap_mode="r")
+    if embeddings.shape[0] != len(queries):
+        logger.warning("%s does not match %s.", path, words_path)
+        return [], None
+    logger.info("Loaded the embeddings of %d queries from %s", len(queries), path)
+    return queries, embeddings
+
+
+def _merge_top_k(best_sims, best_ids, sims, ids, k):
+    """Keeps the k largest of the running and the new (sims, ids) of each row."""
+    sims = np.concatenate([best_sims, sims], axis=1)
+    ids = np.concatenate([best_ids, ids], axis=1)
+    k = min(k, sims.shape[1])
+    rows = np.arange(len(sims))[:, None]
+    top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    return sims[rows, top], ids[rows, top]
+
+
+def _sort_top_k(sims, ids):
+    rows = np.arange(len(sims))[:, None]
+    order = np.argsort(-sims, axis=1, kind="stable")
+    sims, ids = sims[rows, order], ids[rows, order]
+    # Masked personas that filled up a short row are padding too.
+    ids[np.isneginf(sims)] = -1
+    return sims, ids
+
+
+class ExactIndex:
+    """Exhaustive cosine search over the unit-normalized persona embeddings."""
+
+    kind = "exact"
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def top_k(self, queries, k, live=None):
+        """Returns (cos similarities, persona ids) of the k nearest personas of each query.
+
+        Both are arrays of shape (queries, k) sorted by similarity. Rows with
+        fewer than k results are padded with -inf and -1. If live is given,
+        only the personas where it is True are returned.
+        """
+        queries = normalize(queries)
+        best_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for start in range(0, len(self.embeddings), CHUNK_SIZE):
+            chunk = np.asarray(
+                self.embeddings[start : start + CHUNK_SIZE], dtype=np.float32
+            )
+            ids = np.broadcast_to(
+                start + np.arange(len(chunk)), (len(queries), len(chunk))
+            )
+            sims = queries @ chunk.T
+            if live is not None:
+                sims[:, ~live[start : start + len(chunk)]] = -np.inf
+            best_sims, best_ids = _merge_top_k(best_sims, best_ids, sims, ids, k)
+        return _sort_top_k(best_sims, best_ids)
+
+
+class IVFIndex:
+    """Inverted file index: personas are searched only in the nprobe nearest clusters.
+
+    The clusters come from spherical k-means on a sample of the embeddings.
+    Their members are stored contiguously as ids sorted by cluster, with
+    offsets[c]:offsets[c + 1] holding the members of cluster c.
+    """
+
+    kind = "ivf"
+
+    def __init__(
+        self, embeddings, centroids, offsets, ids, nprobe=PERSONA_INDEX_NPROBE
+    ):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, iterations=10, sample_size=65536, seed=0):
+        centroids = train_centroids(embeddings, n_lists, iterations, sample_size, seed)
+        return cls.from_assignments(
+            embeddings, centroids, assign_to_centroids(embeddings, centroids)
+        )
+
+    @classmethod
+    def from_assignments(
+        cls, embeddings, centroids, assignments, nprobe=PERSONA_INDEX_NPROBE
+    ):
+        """Returns the index where persona i is a member of cluster assignments[i]."""
+        ids = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(assignments[ids], np.arange(len(centroids) + 1))
+        return cls(embeddings, centroids, offsets, ids, nprobe)
+
+    def save(self, path):
+        # np.savez appends .npz to names without it.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, offsets=self.offsets, ids=self.ids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, embeddings, nprobe=PERSONA_INDEX_NPROBE):
+        with np.load(path) as data:
+            return cls(
+                embeddings, data["centroids"], data["offsets"], data["ids"], nprobe
+            )
+
+    def top_k(self, queries, k, live=None):
+        """Same as ExactIndex.top_k, over the members of the probed clusters only."""
+        queries = normalize(queries)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)
+        best_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            # Sorted so that the memory-mapped rows are read in order.
+            ids = np.sort(
+                np.concatenate(
+                    [
+                        self.ids[self.offsets[c] : self.offsets[c + 1]]
+                        for c in probes[i, :nprobe]
+                    ]
+                )
+            )
+            if live is not None:
+                ids = ids[live[ids]]
+            sims = np.asarray(self.embeddings[ids], dtype=np.float32) @ query
+            best_sims[i : i + 1], best_ids[i : i + 1] = _merge_top_k(
+                best_sims[i : i + 1], best_ids[i : i + 1], sims[None], ids[None], k
+            )
+        return _sort_top_k(best_sims, best_ids)
+
+
+def train_centroids(embeddings, n_lists=None, iterations=10, sample_size=65536, seed=0):
+    """Returns the unit-normalized centroids of spherical k-means on a sample."""
+    n_lists = n_lists or max(1, int(np.sqrt(len(embeddings))))
+    rng = np.random.default_rng(seed)
+    sample_ids = np.sort(
+        rng.choice(len(embeddings), min(len(embeddings), sample_size), replace=False)
+    )
+    sample = np.asarray(embeddings[sample_ids], dtype=np.float32)
+    n_lists = min(n_lists, len(sample))
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+        # Empty clusters keep their previous centroid.
+        centroids = np.where(counts[:, None] > 0, normalize(sums), centroids)
+    return centroids
+
+
+def assign_to_centroids(embeddings, centroids):
+    """Returns the index of the nearest centroid of each embedding."""
+    assignments = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), CHUNK_SIZE):
+        chunk = np.asarray(embeddings[start : start + CHUNK_SIZE], dtype=np.float32)
+        assignments[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def persona_index_path(csv_path, model_name, kind):
+    key = file_fingerprint(csv_path, model_name)
+    return os.path.join(os.path.dirname(csv_path), f"persona_index.{kind}.{key}.npz")
+
+
+def load_persona_index(csv_path, model_name, embeddings, kind=PERSONA_INDEX):
+    """Returns the persona index of the kind, building and saving it if missing."""
+    if kind == "exact":
+        return ExactIndex(embeddings)
+    if kind != "ivf":
+        raise ValueError(f"Unknown persona index {kind}.")
+
+    path = persona_index_path(csv_path, model_name, kind)
+    if os.path.exists(path):
+        index = IVFIndex.load(path, embeddings)
+        if index.offsets[-1] == len(embeddings):
+            logger.info("Loaded the persona index from %s", path)
+            return index
+        logger.warning("%s does not match the persona embeddings. Rebuilding.", path)
+    logger.info("Building the %s index of %d personas", kind, len(embeddings))
+    index = IVFIndex.build(embeddings)
+    index.save(path)
+    return index
+
+
+class ContradictionMatrix:
+    """Bit matrix where bit (i, j) is set if persona j contradicts persona i.
+
+    Rows are packed with np.packbits, so the matrix of 500 personas is 32 KB.
+    """
+
+    def __init__(self, packed, size):
+        self.packed = packed
+        self.size = size
+
+    def contradicts(self, premise_id, hypothesis_id):
+        byte = self.packed[premise_id, hypothesis_id >> 3]
+        return bool((byte >> (7 - (hypothesis_id & 7))) & 1)
+
+    def row(self, premise_id):
+        """Returns the personas contradicting the persona as a bool array."""
+        return np.unpackbits(self.packed[premise_id], count=self.size).astype(bool)
+
+    def column(self, hypothesis_id):
+        """Returns the personas the persona contradicts as a bool array."""
+        byte = self.packed[:, hypothesis_id >> 3]
+        return ((byte >> (7 - (hypothesis_id & 7))) & 1).astype(bool)
+
+
+def contradiction_matrix_path(csv_path, nli_model_name):
+    key = file_fingerprint(csv_path, nli_model_name)
+    return os.path.join(os.path.dirname(csv_path), f"persona_contradictions.{key}.npy")
+
+
+def load_contradiction_matrix(csv_path, size, nli_model_name):
+    """Returns the ContradictionMatrix built for the CSV and the NLI model, or None."""
+    path = contradiction_matrix_path(csv_path, nli_model_name)
+    if not os.path.exists(path):
+        return None
+    packed = np.load(path)
+    if packed.shape != (size, (size + 7) // 8):
+        logger.warning("%s does not match the persona list.", path)
+        return None
+    logger.info("Loaded persona contradictions from %s", path)
+    return ContradictionMatrix(packed, size)
+
+
+def build_contradiction_matrix(sentences, nli, batch_size=256):
+    """Runs NLI over all the ordered pairs of the sentences."""
+    contradictions = np.zeros((len(sentences), len(sentences)), dtype=bool)
+    pairs = [
+        (i, j) for i in range(len(sentences)) for j in range(len(sentences)) if i != j
+    ]
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start : start + batch_size]
+        labels = nli.predict_batch(
+            [(sentences[i], sentences[j]) for i, j in batch], batch_size=batch_size
+        )
+        for (i, j), label in zip(batch, labels):
+            contradictions[i, j] = label == "contradiction"
+        logger.info("%d / %d pairs", start + len(batch), len(pairs))
+    return np.packbits(contradictions, axis=1)
+
+
+def contradictions(args):
+    from nli import BertNLI
+
+    sentences = list(load_persona_data(args.persona_csv).keys())
+    nli = BertNLI(args.nli_model)
+    packed = build_contradiction_matrix(sentences, nli, args.batch_size)
+    path = contradiction_matrix_path(args.persona_csv, nli.model_name_or_path)
+    save_array(path, packed)
+    logger.info(
+        "Saved %d contradictions between %d personas to %s",
+        int(np.unpackbits(packed).sum()),
+        len(sentences),
+        path,
+    )
+
+
+def queries(args):
+    from object_detection import OBJECTS_VOCAB, load_object_labels
+    from sentence_bert import SentenceBertJapanese
+    from synonym import ChiveSynonyms
+
+    # The embedding of a string depends only on the model, so the synonyms
+    # are stored with their words rather than in the file key.
+    words = dict.fromkeys(load_object_labels(OBJECTS_VOCAB))
+    if args.topn > 0:
+        synonyms = ChiveSynonyms().most_similar_batch(list(words), topn=args.topn)
+        for similar in synonyms.values():
+            words.update(dict.fromkeys(synonym for synonym, _ in similar))
+    words = [word for word in words if word and "\n" not in word]
+
+    model = SentenceBertJapanese()
+    embeddings = model.encode(words, batch_size=args.batch_size, use_cache=False)
+    path = query_embeddings_path(OBJECTS_VOCAB, model.model_name_or_path)
+    tmp_path = f"{path}.txt.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(words))
+    os.replace(tmp_path, f"{path}.txt")
+    save_array(path, embeddings.numpy())
+    logger.info("Saved the embeddings of %d queries to %s", len(words), path)
+
+
+def _load_embeddings(args):
+    from sentence_bert import SentenceBertJapanese
+
+    model = SentenceBertJapanese()
+    sentences = list(load_persona_data(args.persona_csv).keys())
+    return model, load_persona_embeddings(args.persona_csv, sentences, model)
+
+
+def build(args):
+    model, embeddings = _load_embeddings(args)
+    if args.kind == "exact":
+        logger.info("The exact index needs no build.")
+        return
+    started = time.perf_counter()
+    index = IVFIndex.build(embeddings, n_lists=args.lists, iterations=args.iterations)
+    path = persona_index_path(args.persona_csv, model.model_name_or_path, args.kind)
+    index.save(path)
+    logger.info(
+        "Built the %s index of %d personas in %d lists in %.1fs and saved it to %s",
+        args.kind,
+        len(embeddings),
+        len(index.centroids),
+        time.perf_counter() - started,
+        path,
+    )
+
+
+def bench(args):
+    """Reports the recall@k against the exact search and the latency of each nprobe."""
+    from object_detection import OBJECTS_VOCAB
+
+    model, embeddings = _load_embeddings(args)
+    _, queries = load_query_embeddings(OBJECTS_VOCAB, model.model_name_or_path)
+    rng = np.random.default_rng(0)
+    if queries is None:
+        # Personas are used as queries if the query embeddings are not built.
+        queries = embeddings
+    sample = rng.choice(len(queries), min(len(queries), args.queries), replace=False)
+    queries = normalize(queries[np.sort(sample)])
+
+    exact = ExactIndex(embeddings)
+    started = time.perf_counter()
+    _, expected = exact.top_k(queries, args.k)
+    exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    logger.info("exact: recall@%d 1.0000, %.3f ms/query", args.k, exact_ms)
+    if args.kind == "exact":
+        return
+
+    index = load_persona_index(
+        args.persona_csv, model.model_name_or_path, embeddings, args.kind
+    )
+    for nprobe in args.nprobe:
+        index.nprobe = nprobe
+        started = time.perf_counter()
+        _, found = index.top_k(queries, args.k)
+        ms = (time.perf_counter() - started) * 1000 / len(queries)
+        recall = np.mean(
+            [
+                len(set(e[e >= 0]) & set(f[f >= 0])) / max((e >= 0).sum(), 1)
+                for e, f in zip(expected, found)
+            ]
+        )
+        logger.info(
+            "%s nprobe=%d: recall@%d %.4f, %.3f ms/query",
+            args.kind,
+            nprobe,
+            args.k,
+            recall,
+            ms,
+        )
+
+
+def main():
+    from nli import NLI_MODEL
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    contradictions_parser = subparsers.add_parser(
+        "contradictions", help="build the persona contradiction matrix"
+    )
+    contradictions_parser.add_argument("--nli-model", default=NLI_MODEL)
+    contradictions_parser.add_argument("--batch-size", type=int, default=256)
+    contradictions_parser.add_argument("--persona-csv", default=PERSONA_CSV)
+    contradictions_parser.set_defaults(func=contradictions)
+
+    queries_parser = subparsers.add_parser(
+        "queries", help="encode the object labels and their synonyms"
+    )
+    queries_parser.add_argument(
+        "--topn", type=int, default=5, help="chiVe synonyms per label (0 for none)"
+    )
+    queries_parser.add_argument("--batch-size", type=int, default=64)
+    queries_parser.set_defaults(func=queries)
+
+    build_parser = subparsers.add_parser("build", help="build the persona index")
+    build_parser.add_argument("--lists", type=int, help="clusters (default sqrt(n))")
+    build_parser.add_argument("--iterations", type=int, default=10)
+    build_parser.set_defaults(func=build)
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="compare the recall and latency of the persona index"
+    )
+    bench_parser.add_argument("--k", type=int, default=128)
+    bench_parser.add_argument("--queries", type=int, default=200)
+    bench_parser.add_argument(
+        "--nprobe", type=int, nargs="+", default=[PERSONA_INDEX_NPROBE]
+    )
+    bench_parser.set_defaults(func=bench)
+
+    for subparser in (build_parser, bench_parser):
+        subparser.add_argument("--kind", choices=["exact", "ivf"], default="ivf")
+        subparser.add_argument("--persona-csv", default=PERSONA_CSV)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()
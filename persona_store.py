@@ -0,0 +1,694 @@
+"""Versioned persona store updated without re-encoding the unchanged personas.
+
+# Create the store from the persona CSV, or apply the later edits of the CSV.
+python persona_store.py sync --csv ./data/persona_list.csv --index ivf
+python persona_store.py add --desc 私は猫を飼っています。 --label ペット
+python persona_store.py update --desc 私は猫を飼っています。 --label 動物
+python persona_store.py delete --desc 私は猫を飼っています。
+python persona_store.py compact
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+from persona_index import (
+    CHUNK_SIZE,
+    PERSONA_CSV,
+    PERSONA_INDEX,
+    ContradictionMatrix,
+    ExactIndex,
+    IVFIndex,
+    assign_to_centroids,
+    load_persona_data,
+    normalize,
+    save_array,
+    train_centroids,
+)
+
+logger = logging.getLogger(__name__)
+
+PERSONA_STORE = os.environ.get("PERSONA_STORE", "./data/persona_store")
+# Seconds between the checks of a running PersonaCaption for a new version.
+PERSONA_STORE_POLL_SECONDS = float(os.environ.get("PERSONA_STORE_POLL_SECONDS", 10))
+# The store is compacted once this fraction of its rows are deleted.
+PERSONA_STORE_COMPACT_RATIO = float(os.environ.get("PERSONA_STORE_COMPACT_RATIO", 0.2))
+# Pairs of personas run through NLI at once when personas are added.
+NLI_BATCH_SIZE = 256
+# Bits of the contradiction matrix unpacked at once by compaction.
+UNPACK_SIZE = 1 << 26
+
+
+class PersonaSnapshot:
+    """One version of the store.
+
+    Row i is sentences[i] with labels[i] and embeddings[i]. Deleted rows stay
+    in place until compaction and are masked by live. The index and the
+    contradictions (None if the store has no NLI model) cover all the rows.
+    """
+
+    def __init__(
+        self,
+        version,
+        model_name,
+        sentences,
+        labels,
+        embeddings,
+        deleted,
+        index=None,
+        contradictions=None,
+    ):
+        self.version = version
+        self.model_name = model_name
+        self.sentences = sentences
+        self.labels = labels
+        self.embeddings = embeddings
+        self.live = np.ones(len(sentences), dtype=bool)
+        self.live[list(deleted)] = False
+        self.index = index
+        self.contradictions = contradictions
+
+    def persona_data(self):
+        """Returns {persona description: label} of the live rows."""
+        return {
+            sentence: label
+            for sentence, label, live in zip(self.sentences, self.labels, self.live)
+            if live
+        }
+
+
+class PersonaStore:
+    """Personas and their embeddings in append-only files under path.
+
+    personas.<generation>.jsonl and embeddings.<generation>.f32 hold one row
+    per persona in the same order. manifest.json records the version, the
+    number of rows and the deleted rows. It is replaced atomically after the
+    rows are appended, so readers only see whole versions. Deleting a persona
+    adds a tombstone, and compaction rewrites the live rows into the next
+    generation. Writers of any process are serialized with a file lock.
+
+    The writers also keep the search index and the contradiction matrix of
+    the rows, so readers never rebuild them. An appended row is assigned to
+    the existing IVF clusters, and only its pairs with the live rows are run
+    through NLI.
+    """
+
+    def __init__(self, path=PERSONA_STORE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self._manifest_path())
+
+    def version(self):
+        """Returns a version string that changes with every update of the store."""
+        manifest = self._read_manifest()
+        return f"{manifest['store_id']}:{manifest['version']}"
+
+    def nli_model(self):
+        """Returns the NLI model of the contradictions, or None if they are not kept."""
+        return self._read_manifest().get("nli_model")
+
+    def snapshot(self):
+        # The shared lock keeps compaction from removing the files being read.
+        with self._locked(fcntl.LOCK_SH):
+            manifest = self._read_manifest()
+            snapshot = self._snapshot(manifest)
+            snapshot.index = self._index(manifest, snapshot.embeddings)
+            snapshot.contradictions = self._contradiction_matrix(manifest)
+            return snapshot
+
+    def add(self, personas, model, nli=None):
+        """Adds (description, label) pairs, encoding only the new descriptions.
+
+        A description already in the store with another label is updated.
+        """
+        with self._writing() as manifest:
+            data = self._snapshot(manifest).persona_data()
+            new = {}
+            for desc, label in personas:
+                if data.get(desc) != label:
+                    new[desc] = label
+            return self._apply(manifest, model, nli, new, deleted=new.keys())
+
+    def delete(self, descs):
+        with self._writing() as manifest:
+            return self._apply(manifest, None, None, {}, deleted=descs)
+
+    def update(self, desc, model, new_desc=None, label=None, nli=None):
+        with self._writing() as manifest:
+            data = self._snapshot(manifest).persona_data()
+            if desc not in data:
+                raise KeyError(f"{desc} is not in the persona store.")
+            new = {new_desc or desc: label or data[desc]}
+            return self._apply(manifest, model, nli, new, deleted=[desc, *new])
+
+    def sync_csv(self, csv_path, model, nli=None):
+        """Makes the store hold the personas of the CSV, encoding only the changes."""
+        with self._writing() as manifest:
+            data = self._snapshot(manifest).persona_data()
+            csv_data = load_persona_data(csv_path)
+            new = {
+                desc: label
+                for desc, label in csv_data.items()
+                if data.get(desc) != label
+            }
+            deleted = [desc for desc in data if desc not in csv_data or desc in new]
+            return self._apply(manifest, model, nli, new, deleted=deleted)
+
+    def compact(self, min_ratio=0.0):
+        """Rewrites the live rows if at least min_ratio of the rows are deleted."""
+        with self._writing() as manifest:
+            if manifest["rows"] == 0:
+                return manifest["version"]
+            ratio = len(manifest["deleted"]) / manifest["rows"]
+            if not manifest["deleted"] or ratio < min_ratio:
+                return manifest["version"]
+
+            snapshot = self._snapshot(manifest)
+            live = np.flatnonzero(snapshot.live)
+            old_generation = manifest["generation"]
+            generation = old_generation + 1
+            with open(self._file("personas", generation), "w", encoding="utf-8") as f:
+                for i in live:
+                    f.write(_row(snapshot.sentences[i], snapshot.labels[i]))
+            with open(self._file("embeddings", generation), "wb") as f:
+                for start in range(0, len(live), CHUNK_SIZE):
+                    rows = live[start : start + CHUNK_SIZE]
+                    f.write(snapshot.embeddings[rows].tobytes())
+
+            compacted = dict(
+                manifest,
+                version=manifest["version"] + 1,
+                generation=generation,
+                rows=len(live),
+                personas_bytes=os.path.getsize(self._file("personas", generation)),
+                deleted=[],
+                ivf=self._compact_ivf(manifest, live),
+                contradictions=self._compact_contradictions(manifest, live),
+            )
+            self._write_manifest(compacted)
+            # Readers that mapped the old files keep them until they reload.
+            for name in ("personas", "embeddings"):
+                os.remove(self._file(name, old_generation))
+            self._remove_replaced(manifest, compacted)
+            manifest = compacted
+            logger.info(
+                "Compacted the persona store to %d rows (version %d)",
+                len(live),
+                manifest["version"],
+            )
+            return manifest["version"]
+
+    def _apply(self, manifest, model, nli, new, deleted):
+        """Tombstones the deleted descriptions and appends the new rows."""
+        snapshot = self._snapshot(manifest)
+        rows = {s: i for i, s in enumerate(snapshot.sentences) if snapshot.live[i]}
+        tombstones = {rows[desc] for desc in deleted if desc in rows}
+        if not new and not tombstones:
+            return manifest["version"]
+
+        if new:
+            # A label-only change reuses the stored embedding.
+            to_encode = [desc for desc in new if desc not in rows]
+            if to_encode and model.model_name_or_path != manifest["model"]:
+                raise ValueError(
+                    f"The store is encoded with {manifest['model']}, "
+                    f"not {model.model_name_or_path}."
+                )
+            encoded = {}
+            if to_encode:
+                logger.info("Encoding %d personas", len(to_encode))
+                encoded = dict(
+                    zip(
+                        to_encode,
+                        normalize(model.encode(to_encode, use_cache=False).numpy()),
+                    )
+                )
+            embeddings = np.stack(
+                [
+                    (
+                        encoded[desc]
+                        if desc in encoded
+                        else snapshot.embeddings[rows[desc]]
+                    )
+                    for desc in new
+                ]
+            ).astype(np.float32)
+
+        updated = dict(
+            manifest,
+            version=manifest["version"] + 1,
+            rows=manifest["rows"] + len(new),
+            personas_bytes=manifest["personas_bytes"] + _size(new),
+            deleted=sorted(set(manifest["deleted"]) | tombstones),
+        )
+        if new:
+            live = snapshot.live.copy()
+            live[list(tombstones)] = False
+            # A label-only change copies the contradictions of the replaced row.
+            sources = [rows.get(desc) for desc in new]
+            updated["contradictions"] = self._extend_contradictions(
+                manifest, snapshot, live, list(new), sources, nli
+            )
+            self._append(manifest, list(new.items()), embeddings)
+            updated["ivf"] = self._extend_ivf(manifest, updated["rows"])
+        self._write_manifest(updated)
+        self._remove_replaced(manifest, updated)
+        logger.info(
+            "Persona store version %d: %d added, %d deleted, %d rows",
+            updated["version"],
+            len(new),
+            len(tombstones),
+            updated["rows"] - len(updated["deleted"]),
+        )
+        return updated["version"]
+
+    def _extend_ivf(self, manifest, rows):
+        """Returns the IVF state of the first rows rows, given that of manifest.
+
+        Only the rows appended since manifest are assigned to the clusters. The
+        clusters are retrained once the store has grown about 4x since their
+        training, as the lists would be too long for nprobe otherwise.
+        """
+        if manifest.get("index", PERSONA_INDEX) != "ivf":
+            return None
+        ivf = manifest.get("ivf")
+        embeddings = self._embeddings(dict(manifest, rows=rows))
+        if ivf is None or ivf["lists"] < int(np.sqrt(rows)) // 2:
+            logger.info("Training the IVF clusters of %d personas", rows)
+            centroids = train_centroids(embeddings)
+            ivf = {"id": uuid.uuid4().hex[:8], "lists": len(centroids)}
+            save_array(self._file("centroids", ivf["id"]), centroids)
+            start = 0
+        else:
+            centroids = np.load(self._file("centroids", ivf["id"]))
+            start = manifest["rows"]
+        with open(self._file("assignments", ivf["id"]), "ab") as f:
+            # Rows left by an append that did not reach the manifest are cut first.
+            f.truncate(start * 4)
+            f.write(assign_to_centroids(embeddings[start:], centroids).tobytes())
+        return ivf
+
+    def _compact_ivf(self, manifest, kept):
+        """kept holds the ids of the rows kept by the compaction."""
+        ivf = manifest.get("ivf")
+        if ivf is None:
+            return None
+        assignments = self._assignments(manifest)
+        compacted = dict(ivf, id=uuid.uuid4().hex[:8])
+        save_array(
+            self._file("centroids", compacted["id"]),
+            np.load(self._file("centroids", ivf["id"])),
+        )
+        with open(self._file("assignments", compacted["id"]), "wb") as f:
+            f.write(assignments[kept].tobytes())
+        return compacted
+
+    def _extend_contradictions(self, manifest, snapshot, live, new, sources, nli):
+        """Returns the contradictions of manifest extended with the new rows.
+
+        Only the pairs of a new row and a live or another new row are run
+        through NLI. A new row with a source, the row whose label it changes,
+        takes the bits of the source instead.
+        """
+        contradictions = manifest.get("contradictions")
+        if contradictions is None:
+            return None
+        matrix = self._contradiction_matrix(manifest)
+        old_rows = manifest["rows"]
+        rows = old_rows + len(new)
+        sentences = snapshot.sentences + new
+        existing = np.flatnonzero(live)
+        # Bits (j, i) of the new rows, and bits (i, j) of the existing rows.
+        new_rows = np.zeros((len(new), rows), dtype=bool)
+        new_columns = np.zeros((old_rows, len(new)), dtype=bool)
+        pairs = []
+        for a, source in enumerate(sources):
+            j = old_rows + a
+            if source is None:
+                pairs.extend((j, i) for i in existing)
+                pairs.extend((i, j) for i in existing)
+            else:
+                new_rows[a, existing] = matrix.row(source)[existing]
+                new_columns[existing, a] = matrix.column(source)[existing]
+            for b, other in enumerate(sources):
+                if b == a:
+                    continue
+                if source is None or other is None:
+                    pairs.append((j, old_rows + b))
+                else:
+                    new_rows[a, old_rows + b] = matrix.contradicts(source, other)
+
+        if pairs:
+            if nli is None or nli.model_name_or_path != manifest["nli_model"]:
+                raise ValueError(
+                    f"The contradictions of the store need {manifest['nli_model']}."
+                )
+            for start in range(0, len(pairs), NLI_BATCH_SIZE):
+                batch = pairs[start : start + NLI_BATCH_SIZE]
+                labels = nli.predict_batch(
+                    [(sentences[i], sentences[j]) for i, j in batch],
+                    batch_size=NLI_BATCH_SIZE,
+                )
+                for (i, j), label in zip(batch, labels):
+                    if label != "contradiction":
+                        continue
+                    if i >= old_rows:
+                        new_rows[i - old_rows, j] = True
+                    else:
+                        new_columns[i, j - old_rows] = True
+                logger.info("%d / %d pairs", start + len(batch), len(pairs))
+
+        if rows > contradictions["capacity"]:
+            # The rows are widened only when the store doubles.
+            contradictions = {"id": uuid.uuid4().hex[:8], "capacity": _capacity(rows)}
+            self._write_contradictions(contradictions, matrix.packed)
+        width = contradictions["capacity"] // 8
+        path = self._file("contradictions", contradictions["id"])
+        with open(path, "ab") as f:
+            # Rows left by an append that did not reach the manifest are cut first.
+            f.truncate(old_rows * width)
+            f.write(_pack(new_rows, width).tobytes())
+        if old_rows:
+            # Readers of the current version never look at the columns of
+            # the new rows, so they are updated in place.
+            packed = np.memmap(path, dtype=np.uint8, mode="r+", shape=(rows, width))
+            first, last = old_rows >> 3, (rows + 7) >> 3
+            for start in range(0, old_rows, CHUNK_SIZE):
+                stop = min(start + CHUNK_SIZE, old_rows)
+                bits = np.unpackbits(packed[start:stop, first:last], axis=1)
+                bits[:, old_rows - first * 8 :] = 0
+                bits[:, old_rows - first * 8 : rows - first * 8] = new_columns[
+                    start:stop
+                ]
+                packed[start:stop, first:last] = np.packbits(bits, axis=1)
+            packed.flush()
+            del packed
+        return contradictions
+
+    def _compact_contradictions(self, manifest, kept):
+        """kept holds the ids of the rows kept by the compaction."""
+        matrix = self._contradiction_matrix(manifest)
+        if matrix is None:
+            return None
+        contradictions = {"id": uuid.uuid4().hex[:8], "capacity": _capacity(len(kept))}
+        width = contradictions["capacity"] // 8
+        step = max(1, UNPACK_SIZE // max(matrix.size, 1))
+        with open(self._file("contradictions", contradictions["id"]), "wb") as f:
+            for start in range(0, len(kept), step):
+                rows = kept[start : start + step]
+                bits = np.unpackbits(matrix.packed[rows], axis=1, count=matrix.size)
+                f.write(_pack(bits[:, kept], width).tobytes())
+        return contradictions
+
+    def _write_contradictions(self, contradictions, packed):
+        """Writes the rows of packed widened to the capacity of contradictions."""
+        width = contradictions["capacity"] // 8
+        with open(self._file("contradictions", contradictions["id"]), "wb") as f:
+            for start in range(0, len(packed), CHUNK_SIZE):
+                chunk = packed[start : start + CHUNK_SIZE]
+                widened = np.zeros((len(chunk), width), dtype=np.uint8)
+                widened[:, : chunk.shape[1]] = chunk
+                f.write(widened.tobytes())
+
+    def _remove_replaced(self, old, new):
+        """Removes the IVF and contradiction files that new no longer refers to."""
+        for key, names in (
+            ("ivf", ("centroids", "assignments")),
+            ("contradictions", ("contradictions",)),
+        ):
+            replaced = old.get(key)
+            if replaced is None or replaced["id"] == (new.get(key) or {}).get("id"):
+                continue
+            for name in names:
+                os.remove(self._file(name, replaced["id"]))
+
+    def _append(self, manifest, personas, embeddings):
+        generation = manifest["generation"]
+        # Rows left by an append that did not reach the manifest are cut first.
+        with open(self._file("personas", generation), "r+b") as f:
+            f.truncate(manifest["personas_bytes"])
+            f.seek(0, os.SEEK_END)
+            f.write("".join(_row(desc, label) for desc, label in personas).encode())
+        with open(self._file("embeddings", generation), "r+b") as f:
+            f.truncate(manifest["rows"] * manifest["dim"] * 4)
+            f.seek(0, os.SEEK_END)
+            f.write(embeddings.tobytes())
+
+    def _snapshot(self, manifest):
+        with open(self._file("personas", manifest["generation"]), "rb") as f:
+            # Split on b"\n" only: the rows may hold raw U+2028 and the like,
+            # which str.splitlines also treats as line breaks.
+            lines = f.read(manifest["personas_bytes"]).split(b"\n")[:-1]
+        rows = [json.loads(line) for line in lines]
+        return PersonaSnapshot(
+            f"{manifest['store_id']}:{manifest['version']}",
+            manifest["model"],
+            [row["desc"] for row in rows],
+            [row["label"] for row in rows],
+            self._embeddings(manifest),
+            manifest["deleted"],
+        )
+
+    def _embeddings(self, manifest):
+        if not manifest["rows"]:
+            return np.zeros((0, manifest["dim"]), dtype=np.float32)
+        return np.memmap(
+            self._file("embeddings", manifest["generation"]),
+            dtype=np.float32,
+            mode="r",
+            shape=(manifest["rows"], manifest["dim"]),
+        )
+
+    def _assignments(self, manifest):
+        return np.fromfile(
+            self._file("assignments", manifest["ivf"]["id"]),
+            dtype=np.int32,
+            count=manifest["rows"],
+        )
+
+    def _index(self, manifest, embeddings):
+        # Stores created before the index was kept have no "index".
+        kind = manifest.get("index", PERSONA_INDEX)
+        if kind == "ivf" and manifest.get("ivf") is not None:
+            centroids = np.load(self._file("centroids", manifest["ivf"]["id"]))
+            return IVFIndex.from_assignments(
+                embeddings, centroids, self._assignments(manifest)
+            )
+        if kind == "ivf" and manifest["rows"]:
+            logger.warning(
+                "The persona store has no IVF clusters until its next update, "
+                "so it is searched exhaustively."
+            )
+        return ExactIndex(embeddings)
+
+    def _contradiction_matrix(self, manifest):
+        contradictions = manifest.get("contradictions")
+        if contradictions is None:
+            return None
+        width = contradictions["capacity"] // 8
+        if manifest["rows"]:
+            packed = np.memmap(
+                self._file("contradictions", contradictions["id"]),
+                dtype=np.uint8,
+                mode="r",
+                shape=(manifest["rows"], width),
+            )
+        else:
+            packed = np.zeros((0, width), dtype=np.uint8)
+        return ContradictionMatrix(packed, manifest["rows"])
+
+    @contextmanager
+    def _writing(self):
+        with self._lock, self._locked(fcntl.LOCK_EX):
+            yield self._read_manifest()
+
+    @contextmanager
+    def _locked(self, operation):
+        with open(os.path.join(self.path, "lock"), "a") as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def create(self, model, dim, index=PERSONA_INDEX, nli_model=None):
+        """Creates an empty store searched with the index of the kind.
+
+        The contradictions of the personas are kept only if nli_model is given.
+        """
+        if index not in ("exact", "ivf"):
+            raise ValueError(f"Unknown persona index {index}.")
+        os.makedirs(self.path, exist_ok=True)
+        for name in ("personas", "embeddings"):
+            open(self._file(name, 0), "ab").close()
+        contradictions = None
+        if nli_model is not None:
+            contradictions = {"id": uuid.uuid4().hex[:8], "capacity": 0}
+            open(self._file("contradictions", contradictions["id"]), "ab").close()
+        self._write_manifest(
+            {
+                # A recreated store never repeats the versions of the old one.
+                "store_id": uuid.uuid4().hex[:8],
+                "version": 0,
+                "generation": 0,
+                "model": model.model_name_or_path,
+                "dim": dim,
+                "rows": 0,
+                "personas_bytes": 0,
+                "deleted": [],
+                "index": index,
+                "ivf": None,
+                "nli_model": nli_model,
+                "contradictions": contradictions,
+            }
+        )
+
+    def _read_manifest(self):
+        with open(self._manifest_path(), encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        tmp_path = f"{self._manifest_path()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._manifest_path())
+
+    def _manifest_path(self):
+        return os.path.join(self.path, "manifest.json")
+
+    def _file(self, name, key):
+        """key is the generation of the rows, or the id of the derived files."""
+        extension = {
+            "personas": "jsonl",
+            "embeddings": "f32",
+            "centroids": "npy",
+            "assignments": "i32",
+            "contradictions": "u8",
+        }[name]
+        return os.path.join(self.path, f"{name}.{key}.{extension}")
+
+
+def _row(desc, label):
+    return json.dumps({"desc": desc, "label": label}, ensure_ascii=False) + "\n"
+
+
+def _size(personas):
+    return sum(len(_row(desc, label).encode()) for desc, label in personas.items())
+
+
+def _capacity(rows):
+    """Returns the columns of a contradiction matrix of the rows, a power of two."""
+    return max(64, 1 << max(rows - 1, 0).bit_length())
+
+
+def _pack(bits, width):
+    packed = np.zeros((len(bits), width), dtype=np.uint8)
+    packed[:, : (bits.shape[1] + 7) // 8] = np.packbits(bits, axis=1)
+    return packed
+
+
+def _open_store(args, model=None):
+    store = PersonaStore(args.store)
+    if not store.exists():
+        if model is None:
+            raise SystemExit(f"No persona store under {args.store}")
+        from nli import NLI_MODEL
+
+        store.create(
+            model,
+            model.sbert.config.hidden_size,
+            index=args.index,
+            nli_model=None if args.no_contradictions else NLI_MODEL,
+        )
+    return store
+
+
+def _load_model():
+    from sentence_bert import SentenceBertJapanese
+
+    return SentenceBertJapanese()
+
+
+def _load_nli(store):
+    nli_model = store.nli_model()
+    if nli_model is None:
+        return None
+    from nli import BertNLI
+
+    return BertNLI(nli_model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sync_parser = subparsers.add_parser("sync", help="apply the persona CSV")
+    sync_parser.add_argument("--csv", default=PERSONA_CSV)
+    add_parser = subparsers.add_parser("add", help="add a persona")
+    add_parser.add_argument("--desc", required=True)
+    add_parser.add_argument("--label", default="その他")
+    update_parser = subparsers.add_parser("update", help="change a persona")
+    update_parser.add_argument("--desc", required=True)
+    update_parser.add_argument("--new-desc")
+    update_parser.add_argument("--label")
+    delete_parser = subparsers.add_parser("delete", help="delete personas")
+    delete_parser.add_argument("--desc", required=True, action="append")
+    compact_parser = subparsers.add_parser("compact", help="drop the deleted rows")
+    # The index and the contradictions are chosen when the store is created.
+    for subparser in (sync_parser, add_parser):
+        subparser.add_argument(
+            "--index", choices=["exact", "ivf"], default=PERSONA_INDEX
+        )
+        subparser.add_argument(
+            "--no-contradictions",
+            action="store_true",
+            help="run NLI per request instead of keeping the contradictions",
+        )
+    for subparser in (
+        sync_parser,
+        add_parser,
+        update_parser,
+        delete_parser,
+        compact_parser,
+    ):
+        subparser.add_argument("--store", default=PERSONA_STORE)
+    args = parser.parse_args()
+
+    if args.command == "sync":
+        model = _load_model()
+        store = _open_store(args, model)
+        version = store.sync_csv(args.csv, model, _load_nli(store))
+    elif args.command == "add":
+        model = _load_model()
+        store = _open_store(args, model)
+        version = store.add([(args.desc, args.label)], model, _load_nli(store))
+    elif args.command == "update":
+        store = _open_store(args)
+        # The models are loaded only when the description changes.
+        model = _load_model() if args.new_desc else None
+        nli = _load_nli(store) if args.new_desc else None
+        version = store.update(args.desc, model, args.new_desc, args.label, nli)
+    elif args.command == "delete":
+        version = _open_store(args).delete(args.desc)
+    else:
+        version = _open_store(args).compact()
+    logger.info("The persona store is at version %d.", version)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()
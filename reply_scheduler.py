@@ -0,0 +1,35 @@
+import metrics
+from batch_scheduler import BatchScheduler
+
+REPLY_SECONDS = metrics.Histogram(
+    "reply_seconds", "Latency of a reply from its request to its result."
+)
+PENDING = metrics.Gauge(
+    "reply_pending_requests", "Reply requests waiting to be batched."
+)
+
+
+class ReplyScheduler(BatchScheduler):
+    """Collects the reply requests of many chats and decodes them as one batch."""
+
+    def __init__(
+        self,
+        executor,
+        batch_window=0.02,
+        max_batch_size=8,
+        max_inflight=1,
+        max_pending=256,
+    ):
+        super().__init__(
+            executor,
+            "reply_batch",
+            batch_window=batch_window,
+            max_batch_size=max_batch_size,
+            max_inflight=max_inflight,
+            max_pending=max_pending,
+            pending_gauge=PENDING,
+        )
+
+    async def reply(self, message, history, personality):
+        with REPLY_SECONDS.time():
+            return await self.submit(message, history, personality)
@@ -1,13 +1,36 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
 from transformers import BertJapaneseTokenizer, BertModel
 import torch
 
+import metrics
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+
+CACHE_LOOKUPS = metrics.Counter(
+    "embedding_cache_lookups_total",
+    "SentenceBERT embedding cache lookups by result (pinned, hit or miss).",
+)
+
 
 class SentenceBertJapanese:
     def __init__(
         self,
         model_name_or_path="sonoisa/sentence-bert-base-ja-mean-tokens-v2",
         device=None,
+        cache_size=EMBEDDING_CACHE_SIZE,
     ):
+        self.model_name_or_path = model_name_or_path
+        # LRU cache of the embeddings of query strings. The lock is held only
+        # while the cache is read or updated, not while encoding.
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Precomputed embeddings that are never evicted.
+        self._pinned = {}
         self.tokenizer = BertJapaneseTokenizer.from_pretrained(model_name_or_path)
         self.sbert = BertModel.from_pretrained(model_name_or_path)
         self.sbert.eval()
@@ -26,8 +49,43 @@ class SentenceBertJapanese:
             input_mask_expanded.sum(1), min=1e-9
         )
 
+    def pin(self, sentences, embeddings):
+        """Adds precomputed embeddings that encode returns without encoding."""
+        embeddings = torch.from_numpy(np.array(embeddings, dtype=np.float32))
+        self._pinned.update(zip(sentences, embeddings))
+
+    def encode(self, sentences, batch_size=8, use_cache=True):
+        """Returns the embeddings of the sentences stacked on the CPU.
+
+        Only the sentences missing from the cache are encoded.
+        """
+        if not use_cache:
+            return self._encode(sentences, batch_size)
+
+        embeddings = {s: self._pinned[s] for s in sentences if s in self._pinned}
+        pinned = len(embeddings)
+        with self._cache_lock:
+            for sentence in sentences:
+                if sentence in self._cache and sentence not in embeddings:
+                    self._cache.move_to_end(sentence)
+                    embeddings[sentence] = self._cache[sentence]
+        misses = [s for s in dict.fromkeys(sentences) if s not in embeddings]
+        CACHE_LOOKUPS.inc(pinned, result="pinned")
+        CACHE_LOOKUPS.inc(len(sentences) - pinned - len(misses), result="hit")
+        CACHE_LOOKUPS.inc(len(misses), result="miss")
+
+        if misses:
+            embeddings.update(zip(misses, self._encode(misses, batch_size)))
+            with self._cache_lock:
+                for sentence in misses:
+                    self._cache[sentence] = embeddings[sentence]
+                    self._cache.move_to_end(sentence)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return torch.stack([embeddings[sentence] for sentence in sentences])
+
     @torch.no_grad()
-    def encode(self, sentences, batch_size=8):
+    def _encode(self, sentences, batch_size=8):
         all_embeddings = []
         iterator = range(0, len(sentences), batch_size)
         for batch_idx in iterator:
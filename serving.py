@@ -0,0 +1,84 @@
+import os
+
+from admission import AdmissionController
+from caption_scheduler import CaptionScheduler
+from inference_executor import InferenceExecutor
+from model_context import ModelContext
+from reply_scheduler import ReplyScheduler
+
+# "thread" shares the models loaded in this process,
+# "process" loads the models in every worker process.
+INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "thread")
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 1))
+INFERENCE_MAX_PENDING = int(os.environ.get("INFERENCE_MAX_PENDING", 32))
+# Photos captioned at the same time and photos allowed to wait for them.
+PHOTO_MAX_CONCURRENCY = int(os.environ.get("PHOTO_MAX_CONCURRENCY", 1))
+PHOTO_MAX_QUEUE = int(os.environ.get("PHOTO_MAX_QUEUE", 8))
+# Replies of different chats requested within the window are decoded as one batch.
+REPLY_BATCH_WINDOW_MS = int(os.environ.get("REPLY_BATCH_WINDOW_MS", 20))
+REPLY_MAX_BATCH_SIZE = int(os.environ.get("REPLY_MAX_BATCH_SIZE", 8))
+# Photos posted to the HTTP API within the window are captioned as one batch.
+CAPTION_BATCH_WINDOW_MS = int(os.environ.get("CAPTION_BATCH_WINDOW_MS", 20))
+CAPTION_MAX_BATCH_SIZE = int(os.environ.get("CAPTION_MAX_BATCH_SIZE", 8))
+# Run a synthetic image and message through the models before accepting requests.
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+
+# Dialogue model training was used JPersonaChat(5 pairs of personas), so output num is 5.
+PERSONA_OUTPUT_NUM = 5
+
+CONV_AI_PARAMS = {
+    "do_sample": True,
+    "temperature": 1.0,
+    "top_k": 50,
+    "top_p": 0.9,
+    "max_history": 3,
+    "max_length": 50,
+    "min_length": 10,
+}
+
+
+class InferenceServices:
+    """Warm models and the queues in front of them, shared by every front-end."""
+
+    def __init__(self):
+        # Load every model once so that request handlers only run inference.
+        if INFERENCE_EXECUTOR == "process":
+            # Every worker process loads its own models.
+            self.models = None
+        else:
+            self.models = ModelContext(CONV_AI_PARAMS)
+        self.executor = InferenceExecutor(
+            models=self.models,
+            kind=INFERENCE_EXECUTOR,
+            max_workers=INFERENCE_WORKERS,
+            max_pending=INFERENCE_MAX_PENDING,
+            model_kwargs={"conv_ai_params": CONV_AI_PARAMS},
+            warm_up=WARMUP,
+        )
+        self.photo_admission = AdmissionController(
+            "Photo", max_depth=PHOTO_MAX_QUEUE, max_concurrency=PHOTO_MAX_CONCURRENCY
+        )
+        self.reply_scheduler = ReplyScheduler(
+            self.executor,
+            batch_window=REPLY_BATCH_WINDOW_MS / 1000,
+            max_batch_size=REPLY_MAX_BATCH_SIZE,
+            max_inflight=INFERENCE_WORKERS,
+        )
+        # The photo limits bound the batches and the photos waiting for them.
+        self.caption_scheduler = CaptionScheduler(
+            self.executor,
+            batch_window=CAPTION_BATCH_WINDOW_MS / 1000,
+            max_batch_size=CAPTION_MAX_BATCH_SIZE,
+            max_inflight=PHOTO_MAX_CONCURRENCY,
+            max_pending=PHOTO_MAX_QUEUE,
+        )
+
+    @property
+    def ready(self):
+        return self.executor.ready
+
+    async def start(self):
+        await self.executor.start()
+
+    def shutdown(self):
+        self.executor.shutdown()
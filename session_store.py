@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SESSIONS = metrics.Gauge("chat_sessions", "Chat sessions held in the session store.")
+
+
+class ChatSession:
+    def __init__(self):
+        self.persona_list = []
+        self.dialog_history = []
+        # Serializes the handlers of one chat so that the history is updated in order.
+        self.lock = asyncio.Lock()
+        self.last_access = time.monotonic()
+
+    def reset(self):
+        self.persona_list = []
+        self.dialog_history = []
+
+
+class SessionStore:
+    """Per-chat sessions bounded by LRU eviction and idle TTL.
+
+    None of the methods await, so they are atomic with respect to the asyncio
+    handlers running on the same event loop.
+    """
+
+    def __init__(self, max_sessions=10000, ttl=3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, chat_id):
+        now = time.monotonic()
+        self._expire(now)
+        session = self._sessions.get(chat_id)
+        if session is None:
+            session = ChatSession()
+            self._sessions[chat_id] = session
+            while len(self._sessions) > self.max_sessions:
+                evicted_id, _ = self._sessions.popitem(last=False)
+                logger.info("Session of chat %s was evicted.", evicted_id)
+        else:
+            self._sessions.move_to_end(chat_id)
+        SESSIONS.set(len(self._sessions))
+        session.last_access = now
+        return session
+
+    def pop(self, chat_id):
+        session = self._sessions.pop(chat_id, None)
+        SESSIONS.set(len(self._sessions))
+        return session
+
+    def _expire(self, now):
+        # Sessions are ordered by last access, so the idle ones are at the front.
+        while self._sessions:
+            chat_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            logger.info("Session of chat %s expired.", chat_id)
@@ -0,0 +1,379 @@
+"""Synonym lookup over chiVe and the precomputed synonym table.
+
+# Precompute the synonyms of the object labels, age answers and extra words.
+python synonym.py build --topn 20 --vocab ./data/vqa_answer_words.txt
+# Build a small float16 chiVe and report its recall against the full one.
+python synonym.py prune --output-dir ./data/chive-small --max-words 100000
+python synonym.py recall --pruned-dir ./data/chive-small
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+
+import numpy as np
+from gensim.models import KeyedVectors
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHIVE_DIR = os.environ.get("CHIVE_DIR", "./data/chive")
+SYNONYM_TABLE = os.environ.get("SYNONYM_TABLE", "./data/synonym_table.json")
+# Rows of the chiVe matrix multiplied at once by most_similar_exact.
+SEARCH_CHUNK_SIZE = 65536
+
+LOOKUPS = metrics.Counter(
+    "synonym_lookups_total", "Synonym lookups by the source that answered them."
+)
+
+
+def load_chive(chive_dir=CHIVE_DIR):
+    """Returns the chiVe KeyedVectors memory-mapped read-only, or None."""
+    if not os.path.exists(chive_dir):
+        logger.error("chiVe vector is not placed under %s", chive_dir)
+
+    kv_file = sorted(glob.glob(os.path.join(chive_dir, "*.kv")))
+    npy_file = glob.glob(os.path.join(chive_dir, "*.npy"))
+    if not kv_file or not npy_file:
+        logger.error("chiVe vector .kv or .npy file is not placed under %s", chive_dir)
+        return None
+
+    logger.info("Loading chiVe vectors from %s", kv_file[0])
+    word2vec_model = KeyedVectors.load(kv_file[0], mmap="r")
+    norms_file = f"{kv_file[0]}.norms.npy"
+    if os.path.exists(norms_file):
+        # Saved by the prune command.
+        word2vec_model.norms = np.load(norms_file, mmap_mode="r")
+    else:
+        # The norms are computed here once instead of on the first request.
+        word2vec_model.fill_norms()
+    word2vec_model.source = os.path.basename(kv_file[0])
+    return word2vec_model
+
+
+def most_similar_exact(word2vec_model, words, topn=5, chunk_size=SEARCH_CHUNK_SIZE):
+    """Returns the (synonym, cos similarity) list of each word, which must be in chiVe.
+
+    Gives the same result as most_similar for each word, but the vectors of all
+    the words are multiplied with the chiVe matrix in one pass over it, chunk by
+    chunk so that the memory-mapped matrix is never copied as a whole.
+    """
+    keys = np.array([word2vec_model.get_index(word) for word in words])
+    queries = np.stack(
+        [word2vec_model.get_vector(word, norm=True) for word in words]
+    ).astype(np.float32)
+    vectors = word2vec_model.vectors
+    norms = np.clip(word2vec_model.norms, 1e-12, None)
+    rows = np.arange(len(words))[:, None]
+
+    best_ids = np.empty((len(words), 0), dtype=np.int64)
+    best_sims = np.empty((len(words), 0), dtype=np.float32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start : start + chunk_size], dtype=np.float32)
+        sims = queries @ chunk.T / norms[start : start + len(chunk)]
+        # A word is not its own synonym.
+        own = (keys >= start) & (keys < start + len(chunk))
+        sims[own, keys[own] - start] = -np.inf
+
+        ids = np.concatenate(
+            [best_ids, np.broadcast_to(start + np.arange(len(chunk)), sims.shape)],
+            axis=1,
+        )
+        sims = np.concatenate([best_sims, sims], axis=1)
+        k = min(topn, sims.shape[1])
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        best_ids, best_sims = ids[rows, top], sims[rows, top]
+
+    order = np.argsort(-best_sims, axis=1, kind="stable")
+    best_ids, best_sims = best_ids[rows, order], best_sims[rows, order]
+    return [
+        [
+            (word2vec_model.index_to_key[i], float(sim))
+            for i, sim in zip(ids, sims)
+            if sim > -np.inf
+        ]
+        for ids, sims in zip(best_ids, best_sims)
+    ]
+
+
+def most_similar_all(word2vec_model, words, topn=5, batch_size=256):
+    """Returns {word: [(synonym, cos similarity), ...]} of the words in chiVe."""
+    in_vocab = [word for word in words if word in word2vec_model]
+    result = {}
+    for start in range(0, len(in_vocab), batch_size):
+        batch = in_vocab[start : start + batch_size]
+        result.update(zip(batch, most_similar_exact(word2vec_model, batch, topn)))
+    return result
+
+
+def load_table(path=SYNONYM_TABLE):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        table = json.load(f)
+    logger.info(
+        "Loaded the synonyms of %d words (topn = %d) from %s",
+        len(table["synonyms"]),
+        table["topn"],
+        path,
+    )
+    return table
+
+
+class ChiveSynonyms:
+    """Synonym lookup over the chiVe word vectors.
+
+    The vectors are loaded once and memory-mapped read-only, so the worker
+    processes of one host share the same pages of the .npy file. Words in the
+    precomputed synonym table are answered from the table, and chiVe is only
+    searched for the other words.
+    """
+
+    def __init__(self, chive_dir=CHIVE_DIR, table_path=SYNONYM_TABLE):
+        self.word2vec_model = load_chive(chive_dir)
+        self.table = load_table(table_path)
+        # Identifies the vectors and the table that the synonyms come from.
+        self.version = ":".join(
+            [
+                getattr(self.word2vec_model, "source", ""),
+                table_path if self.table is not None else "",
+                str(os.path.getmtime(table_path)) if self.table is not None else "",
+            ]
+        )
+        if self.word2vec_model is None and self.table is None:
+            logger.warning("Could not extract synonyms.")
+        if (
+            self.word2vec_model is not None
+            and self.table is not None
+            and self.table["chive"] != self.word2vec_model.source
+        ):
+            logger.warning(
+                "%s was built from %s, not %s.",
+                table_path,
+                self.table["chive"],
+                self.word2vec_model.source,
+            )
+
+    @property
+    def available(self):
+        return self.word2vec_model is not None or self.table is not None
+
+    def most_similar(self, word, topn=5):
+        """Returns (synonym, cos similarity) of the topn nearest words."""
+        return self.most_similar_batch([word], topn)[word]
+
+    def most_similar_batch(self, words, topn=5):
+        """Returns {word: [(synonym, cos similarity), ...]} for all the words.
+
+        The words missing from the table are searched in chiVe together.
+        """
+        result = {}
+        live_words = []
+        use_table = self.table is not None and topn <= self.table["topn"]
+        for word in dict.fromkeys(words):
+            if use_table and word in self.table["synonyms"]:
+                LOOKUPS.inc(source="table")
+                result[word] = [
+                    (synonym, sim)
+                    for synonym, sim in self.table["synonyms"][word][:topn]
+                ]
+            elif self.word2vec_model is not None and word in self.word2vec_model:
+                LOOKUPS.inc(source="chive")
+                live_words.append(word)
+            else:
+                LOOKUPS.inc(source="none")
+                result[word] = []
+        if live_words:
+            result.update(
+                zip(
+                    live_words,
+                    most_similar_exact(self.word2vec_model, live_words, topn),
+                )
+            )
+        return result
+
+
+def closed_vocabulary(vocab_files=()):
+    """Returns the words expected as queries: object labels, age answers and the given files."""
+    # Imported here so that the lookup above does not need the vision models.
+    from object_detection import load_object_labels
+    from vqa import AGE_ANSWERS
+
+    words = dict.fromkeys(load_object_labels())
+    words.update(dict.fromkeys(AGE_ANSWERS))
+    for path in vocab_files:
+        with open(path, encoding="utf-8") as f:
+            words.update(dict.fromkeys(line.strip() for line in f if line.strip()))
+    return list(words)
+
+
+def build(args):
+    word2vec_model = load_chive(args.chive_dir)
+    if word2vec_model is None:
+        raise SystemExit(f"chiVe is not found under {args.chive_dir}")
+
+    words = closed_vocabulary(args.vocab)
+    # Words out of the chiVe vocabulary are stored too, so that they are
+    # answered from the table without a live lookup.
+    synonyms = {word: [] for word in words}
+    similar_words = most_similar_all(word2vec_model, words, args.topn, args.batch_size)
+    for word, similar in similar_words.items():
+        synonyms[word] = [[synonym, round(sim, 3)] for synonym, sim in similar]
+    table = {"chive": word2vec_model.source, "topn": args.topn, "synonyms": synonyms}
+
+    tmp_path = f"{args.output}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(table, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, args.output)
+    logger.info(
+        "Saved the synonyms of %d words (%d in chiVe) to %s",
+        len(words),
+        sum(1 for v in synonyms.values() if v),
+        args.output,
+    )
+
+
+def persona_words(persona_csv):
+    """Returns the words of the persona descriptions tokenized by GiNZA."""
+    import spacy
+
+    from persona_index import load_persona_data
+
+    nlp = spacy.load("ja_ginza")
+    words = {}
+    for desc in load_persona_data(persona_csv):
+        for tok in nlp(desc):
+            words[tok.text] = None
+            words[tok.lemma_] = None
+    return list(words)
+
+
+def prune(args):
+    """Saves the chiVe vectors of the relevant words as float16 KeyedVectors."""
+    word2vec_model = load_chive(args.chive_dir)
+    if word2vec_model is None:
+        raise SystemExit(f"chiVe is not found under {args.chive_dir}")
+
+    # The chiVe vocabulary is ordered by frequency.
+    keep = dict.fromkeys(word2vec_model.index_to_key[: args.max_words])
+    queries = closed_vocabulary(args.vocab)
+    keep.update(dict.fromkeys(queries))
+    keep.update(dict.fromkeys(persona_words(args.persona_csv)))
+    # The synonyms of the expected queries are kept so that their neighbors
+    # stay the same in the pruned vectors.
+    for similar in most_similar_all(
+        word2vec_model, queries, args.topn, args.batch_size
+    ).values():
+        keep.update(dict.fromkeys(synonym for synonym, _ in similar))
+    keys = [word for word in keep if word in word2vec_model]
+
+    # Sorted so that the pruned vocabulary keeps the frequency order.
+    indices = np.sort([word2vec_model.get_index(word) for word in keys])
+    vectors = np.empty((len(indices), word2vec_model.vector_size), dtype=np.float16)
+    for start in range(0, len(indices), SEARCH_CHUNK_SIZE):
+        chunk = indices[start : start + SEARCH_CHUNK_SIZE]
+        vectors[start : start + len(chunk)] = word2vec_model.vectors[chunk]
+    pruned = KeyedVectors(word2vec_model.vector_size, dtype=np.float16)
+    pruned.add_vectors([word2vec_model.index_to_key[i] for i in indices], vectors)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    kv_path = os.path.join(args.output_dir, "chive-pruned.kv")
+    # The vectors are stored in their own .npy so that they can be memory-mapped.
+    pruned.save(kv_path, separately=["vectors"], ignore=["norms"])
+    np.save(
+        f"{kv_path}.norms.npy",
+        np.linalg.norm(pruned.vectors.astype(np.float32), axis=1),
+    )
+    logger.info(
+        "Saved %d of %d chiVe words (%.1f MB) to %s",
+        len(keys),
+        len(word2vec_model),
+        pruned.vectors.nbytes / 2**20,
+        kv_path,
+    )
+    args.pruned_dir = args.output_dir
+    recall(args)
+
+
+def recall(args):
+    """Reports how many of the full chiVe synonyms the pruned vectors find.
+
+    The synonyms of the expected queries are kept by prune, so the words of the
+    persona descriptions are reported too as words whose neighbors may be lost.
+    """
+    full = load_chive(args.chive_dir)
+    pruned = load_chive(args.pruned_dir)
+    if full is None or pruned is None:
+        raise SystemExit("chiVe is not found.")
+
+    word_sets = {
+        "queries": closed_vocabulary(args.vocab),
+        "persona words": persona_words(args.persona_csv),
+    }
+    for name, words in word_sets.items():
+        expected = most_similar_all(full, words, args.topn, args.batch_size)
+        found = most_similar_all(pruned, words, args.topn, args.batch_size)
+        recalls = []
+        for word, similar in expected.items():
+            synonyms = {synonym for synonym, _ in similar}
+            pruned_synonyms = {synonym for synonym, _ in found.get(word, [])}
+            recalls.append(len(synonyms & pruned_synonyms) / max(len(synonyms), 1))
+        logger.info(
+            "Recall@%d of the pruned vectors for %s: %.4f over %d words "
+            "(%d words are missing from the pruned vectors)",
+            args.topn,
+            name,
+            float(np.mean(recalls)) if recalls else 0.0,
+            len(recalls),
+            len(set(expected) - set(found)),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="build the synonym table")
+    build_parser.add_argument("--output", default=SYNONYM_TABLE)
+    build_parser.set_defaults(func=build)
+
+    prune_parser = subparsers.add_parser(
+        "prune", help="build float16 chiVe vectors of the relevant words"
+    )
+    prune_parser.add_argument("--output-dir", default="./data/chive-small")
+    prune_parser.add_argument(
+        "--max-words", type=int, default=100000, help="most frequent words to keep"
+    )
+    prune_parser.set_defaults(func=prune)
+
+    recall_parser = subparsers.add_parser(
+        "recall", help="compare the synonyms of pruned chiVe with the full one"
+    )
+    recall_parser.add_argument("--pruned-dir", default="./data/chive-small")
+    recall_parser.set_defaults(func=recall)
+
+    for subparser in (build_parser, prune_parser, recall_parser):
+        subparser.add_argument("--chive-dir", default=CHIVE_DIR, help="full chiVe")
+        subparser.add_argument("--persona-csv", default="./data/persona_list.csv")
+        subparser.add_argument("--topn", type=int, default=20)
+        subparser.add_argument("--batch-size", type=int, default=256)
+        subparser.add_argument(
+            "--vocab",
+            action="append",
+            default=[],
+            help="file of extra words, one per line (e.g. words seen in VQA answers)",
+        )
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()
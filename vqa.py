@@ -7,17 +7,17 @@ import spacy
 
 logger = logging.getLogger(__name__)
 
+# Answers of _get_age_answer for numeric and "young" answers.
+AGE_ANSWERS = ("10代", "20代", "30代", "老い")
+
 
 class Vqa:
     def __init__(
         self,
-        normalize_boxes,
-        roi_features,
         model_name_or_path="sonoisa/vl-t5-base-japanese",
         device=None,
     ):
-        self.roi_features = roi_features
-        self.normalized_boxes = normalize_boxes
+        self.model_name_or_path = model_name_or_path
         if device is None:
             self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.vlt5 = VLT5Model.from_pretrained(model_name_or_path)
@@ -28,48 +28,61 @@ class Vqa:
         )
         self.vlt5.resize_token_embeddings(self.tokenizer.vocab_size)
         self.vlt5.tokenizer = self.tokenizer
-
-    def get_answer(self, questions):
         self.vlt5.eval()
-        box_ids = set()
-        answer_list = []
 
-        nlp = spacy.load("ja_ginza")
+        self.nlp = spacy.load("ja_ginza")
+
+    def get_answer(self, questions, normalized_boxes, roi_features):
+        return self.get_answers(questions, normalized_boxes, roi_features)[0]
 
-        logger.info("Getting answers to my question about the image.")
-        for question in questions:
-            input_ids = self.tokenizer(
-                question, return_tensors="pt", padding=True
-            ).input_ids.to(self.device)
-            vis_feats = self.roi_features.to(self.device)
-            boxes = self.normalized_boxes.to(self.device)
+    def get_answers(self, questions, normalized_boxes, roi_features, batch_size=32):
+        """Answers every question about every image of the batch.
+
+        normalized_boxes and roi_features are batched over the images, and the
+        (image, question) pairs are generated batch_size at a time.
+        """
+        pairs = [
+            (i, question) for i in range(len(roi_features)) for question in questions
+        ]
+        answer_lists = [[] for _ in range(len(roi_features))]
+
+        logger.info(
+            "Getting answers to my questions about %d images.", len(roi_features)
+        )
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start : start + batch_size]
+            image_ids = torch.tensor([i for i, _ in batch])
+            inputs = self.tokenizer(
+                [question for _, question in batch], return_tensors="pt", padding=True
+            ).to(self.device)
+            vis_feats = roi_features[image_ids].to(self.device)
+            boxes = normalized_boxes[image_ids].to(self.device)
 
             # Generate answers
             output = self.vlt5.generate(
-                input_ids=input_ids,
+                input_ids=inputs.input_ids,
+                attention_mask=inputs.attention_mask,
                 vis_inputs=(vis_feats, boxes),
             )
-            generated_sent = self.tokenizer.batch_decode(
-                output, skip_special_tokens=False
-            )[0]
-            generated_sent = re.sub("[ ]*(<pad>|</s>)[ ]*", "", generated_sent)
-
-            if "<vis_extra_id_" in generated_sent:
-                match = re.match(r"<vis_extra_id_(\d+)>", generated_sent)
-                box_id = int(match.group(1))
-                box_ids.add(box_id)
+            generated_sents = [
+                re.sub("[ ]*(<pad>|</s>)[ ]*", "", generated_sent)
+                for generated_sent in self.tokenizer.batch_decode(
+                    output, skip_special_tokens=False
+                )
+            ]
 
-            logger.info(f"{question}")
-            logger.info(f"  -> {generated_sent}")
+            docs = self.nlp.pipe(generated_sents)
+            for (i, question), generated_sent, doc in zip(batch, generated_sents, docs):
+                logger.info(f"{question}")
+                logger.info(f"  -> {generated_sent}")
 
-            doc = nlp(generated_sent)
-            if ("何歳" or "年齢") in question:
-                answer_list.append(self._get_age_answer(doc))
-            else:
-                for tok in doc:
-                    if tok.pos_ in ("NOUN", "PRON", "PROPN", "ADJ", "VERB"):
-                        answer_list.append(tok.text)
-        return list(set(answer_list))
+                if ("何歳" or "年齢") in question:
+                    answer_lists[i].append(self._get_age_answer(doc))
+                else:
+                    for tok in doc:
+                        if tok.pos_ in ("NOUN", "PRON", "PROPN", "ADJ", "VERB"):
+                            answer_lists[i].append(tok.text)
+        return [list(set(answer_list)) for answer_list in answer_lists]
 
     def _get_age_answer(self, doc):
         for tok in doc: